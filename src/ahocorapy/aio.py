@@ -0,0 +1,102 @@
+'''
+asyncio helpers.
+
+Searching a big text with KeywordTree.search_all blocks the event loop until
+the whole text has been searched. search_chunks searches data arriving
+through an async iterator in small slices and hands control back to the
+event loop in between. AsyncSearcher runs whole searches in a thread or
+process pool.
+
+Requires python 3.7 or newer.
+'''
+
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+from ahocorapy.parallel import _init_worker, _search_batch, _search_text, \
+    _worker_arguments
+
+
+async def search_chunks(kwtree, chunks, slice_size=4096):
+    '''
+    Searches the chunks of an async iterator (e.g. data read from a socket)
+    like KeywordTree.search_stream. After every slice_size characters (or
+    bytes) control is handed back to the event loop.
+    @return: Async generator of 2-Tuples with keyword and startindex
+             relative to the beginning of all chunks.
+    '''
+    scanner = kwtree.scanner()
+    async for chunk in chunks:
+        for start in range(0, len(chunk), slice_size):
+            for result in scanner.feed(chunk[start:start + slice_size]):
+                yield result
+            await asyncio.sleep(0)
+
+
+class AsyncSearcher(object):
+    '''
+    Runs searches of a finalized KeywordTree in an executor, so the event
+    loop is not blocked while searching.
+    '''
+
+    def __init__(self, kwtree, executor=None, processes=None):
+        '''
+        @param kwtree: A finalized KeywordTree.
+        @param executor: concurrent.futures.ThreadPoolExecutor to search in.
+                         Defaults to the default executor of the event loop.
+        @param processes: If given, a pool of this many worker processes is
+                          started instead. Every worker receives the tree
+                          once (see ahocorapy.parallel.ParallelSearcher).
+        '''
+        if not kwtree._finalized:
+            raise ValueError('KeywordTree has not been finalized.' +
+                             ' No search allowed. Call finalize() first.')
+        self._kwtree = kwtree
+        self._own_executor = processes is not None
+        if self._own_executor:
+            executor = ProcessPoolExecutor(
+                processes, initializer=_init_worker,
+                initargs=_worker_arguments(kwtree))
+        self._executor = executor
+
+    async def search_all(self, text):
+        '''
+        Same as KeywordTree.search_all, but returns a list.
+        '''
+        if self._own_executor:
+            return await self._run(_search_text, text)
+        return await self._run(_list_search_all, self._kwtree, text)
+
+    async def search_many(self, texts):
+        '''
+        Same as KeywordTree.search_many, but returns a list.
+        '''
+        texts = list(texts)
+        if self._own_executor:
+            return await self._run(_search_batch, (0, texts))
+        return await self._run(_list_search_many, self._kwtree, texts)
+
+    def _run(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self._executor, function, *args)
+
+    def close(self):
+        '''
+        Stops the worker processes, if they were started by this searcher.
+        '''
+        if self._own_executor:
+            self._executor.shutdown()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _list_search_all(kwtree, text):
+    return list(kwtree.search_all(text))
+
+
+def _list_search_many(kwtree, texts):
+    return list(kwtree.search_many(texts))
@@ -0,0 +1,903 @@
+'''
+Compact, array backed representation of a finalized KeywordTree.
+
+Instead of one State object with its own transitions dict per node, the
+whole automaton is stored in a handful of flat arrays. Only the goto edges
+of the trie are kept (no shortcut transitions), failure and output links
+are resolved during the search.
+
+Texts are folded (see ahocorapy.folding) by the KeywordTree before they are
+passed to the automaton.
+'''
+
+from array import array
+from bisect import bisect_left
+from builtins import map, object
+from collections import Counter
+import json
+import mmap
+import struct
+import sys
+
+from ahocorapy.folding import Folding, OFFSET_TYPECODE
+
+
+# Every array stores signed 32bit values. -1 marks "no keyword" in the
+# keyword id array, 0 (the zero state) marks "no output" in the output array.
+TYPECODE = 'i'
+
+# On disk layout: header followed by offsets, symbols, targets, suffixes,
+# outputs, keyword_ids, keyword offsets and the utf-8 encoded keywords.
+# If FLAG_VALUES is set, the values of the keywords follow as a JSON list
+# up to the end of the file. Every section starts at a multiple of
+# ALIGNMENT, all integers are little endian.
+MAGIC = b'AHOCORPY'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sIIQQQQ')
+ALIGNMENT = 8
+FLAG_CASE_INSENSITIVE = 1
+FLAG_BINARY = 2
+FLAG_VALUES = 4
+FLAG_NORMALIZE = 8
+FLAG_WORD_BOUNDARIES = 16
+FLAG_MINIMIZED = 32
+
+# Match selection modes, see KeywordTree.search_all
+OVERLAPPING = 'overlapping'
+NON_OVERLAPPING = 'non_overlapping'
+LEFTMOST_FIRST = 'leftmost_first'
+LEFTMOST_LONGEST = 'leftmost_longest'
+MODES = (OVERLAPPING, NON_OVERLAPPING, LEFTMOST_FIRST, LEFTMOST_LONGEST)
+
+# Word characters of binary trees without custom word characters
+_ASCII_WORD_BYTES = frozenset(bytearray(
+    b'0123456789_ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'))
+
+
+def _is_word_character(char):
+    return char.isalnum() or char == '_'
+
+
+def word_character_test(binary=False, word_characters=None):
+    '''
+    @param word_characters: str (or bytes for binary trees) of the
+                            characters words consist of. Defaults to
+                            alphanumeric characters and '_' (ASCII only for
+                            binary trees).
+    @return: Function telling whether an item of a text (a character or a
+             byte value) is part of a word.
+    '''
+    if word_characters is None:
+        if binary:
+            return _ASCII_WORD_BYTES.__contains__
+        return _is_word_character
+    if binary:
+        return frozenset(bytearray(word_characters)).__contains__
+    return frozenset(word_characters).__contains__
+
+
+def _padding(size):
+    return -size % ALIGNMENT
+
+
+def _to_little_endian(values):
+    if sys.byteorder != 'little':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values
+
+
+def _typecode(code):
+    # Typecode of the array holding the integers of struct format code
+    return OFFSET_TYPECODE if code == 'q' else code
+
+
+def _little_endian_bytes(values, code):
+    # The integers of values as written to disk (struct format code)
+    if values.itemsize != struct.calcsize(code):
+        return struct.pack('<{0}{1}'.format(len(values), code), *values)
+    values = _to_little_endian(values)
+    if hasattr(values, 'tobytes'):
+        return values.tobytes()
+    return values.tostring()
+
+
+def _read_array(section, code):
+    # The integers of a section written by _little_endian_bytes. On little
+    # endian machines they are used without copying them (memoryview.cast
+    # exists since python 3.3).
+    if sys.byteorder == 'little' and hasattr(section, 'cast'):
+        return section.cast(code)
+    typecode = _typecode(code)
+    data = section.tobytes()
+    if array(typecode).itemsize != struct.calcsize(code):
+        return array(typecode, struct.unpack(
+            '<{0}{1}'.format(len(data) // struct.calcsize(code), code),
+            data))
+    values = array(typecode, data)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+
+class CompactAutomaton(object):
+    '''
+    Frozen automaton. For state s the outgoing goto edges are stored in
+    symbols[offsets[s]:offsets[s + 1]] (sorted by symbol code) and
+    targets[offsets[s]:offsets[s + 1]]. suffixes holds the longest strict
+    suffix (failure link) of every state, outputs the next state on the
+    suffix chain that matches a keyword and keyword_ids the index into
+    keywords (and values) for states that match a keyword themselves.
+    States of a minimized automaton (see minimized()) are shared by several
+    keywords, their keyword_ids only mark them as matching.
+    '''
+
+    def __init__(self, offsets, symbols, targets, suffixes, outputs,
+                 keyword_ids, keywords, case_insensitive=False, binary=False,
+                 values=None, normalize=False, word_boundaries=False,
+                 word_characters=None, minimized=False):
+        self._offsets = offsets
+        self._symbols = symbols
+        self._targets = targets
+        self._suffixes = suffixes
+        self._outputs = outputs
+        self._keyword_ids = keyword_ids
+        self._keywords = keywords
+        self._values = values
+        self._case_insensitive = case_insensitive
+        self._binary = binary
+        self._normalize = normalize
+        self._word_boundaries = word_boundaries
+        self._word_characters = word_characters
+        self._minimized = minimized
+        self._depths = None
+        self._keyword_index = None
+        self._mapped = None
+        self._path = None
+
+    @classmethod
+    def from_zero_state(cls, zero_state, case_insensitive=False,
+                        binary=False, normalize=False, word_boundaries=False,
+                        word_characters=None):
+        '''
+        Builds the compact automaton from the trie starting at zero_state.
+        States are renumbered breadth first, so that every state is
+        processed after its parent and its suffix. Keywords are numbered in
+        the order they were added, so the keyword id is the priority of a
+        keyword. If binary is true the symbols are byte values instead of
+        characters.
+        '''
+        offsets = array(TYPECODE, [0])
+        symbols = array(TYPECODE)
+        targets = array(TYPECODE)
+        keyword_states = []
+        order = [zero_state]
+        idx = 0
+        while idx < len(order):
+            state = order[idx]
+            if state.success:
+                keyword_states.append((state.priority, idx))
+            idx += 1
+            for symbol in sorted(state.transitions):
+                child = state.transitions[symbol]
+                if child.parent is not state:
+                    # Shortcut transition of a finalized tree
+                    continue
+                symbols.append(symbol if binary else ord(symbol))
+                targets.append(len(order))
+                order.append(child)
+            offsets.append(len(symbols))
+        keyword_states.sort()
+        keyword_ids = array(TYPECODE, [-1]) * len(order)
+        keywords = []
+        values = []
+        for _, idx in keyword_states:
+            keyword_ids[idx] = len(keywords)
+            keywords.append(order[idx].matched_keyword)
+            values.append(order[idx].value)
+        del order
+
+        state_count = len(keyword_ids)
+        suffixes = array(TYPECODE, [0]) * state_count
+        outputs = array(TYPECODE, [0]) * state_count
+        for state in range(1, state_count):
+            for pos in range(offsets[state], offsets[state + 1]):
+                child = targets[pos]
+                symbol = symbols[pos]
+                traversed = suffixes[state]
+                while True:
+                    lo = offsets[traversed]
+                    hi = offsets[traversed + 1]
+                    found = bisect_left(symbols, symbol, lo, hi)
+                    if found != hi and symbols[found] == symbol:
+                        suffixes[child] = targets[found]
+                        break
+                    if traversed == 0:
+                        break
+                    traversed = suffixes[traversed]
+                suffix = suffixes[child]
+                if keyword_ids[suffix] >= 0:
+                    outputs[child] = suffix
+                else:
+                    outputs[child] = outputs[suffix]
+        if all(value is None for value in values):
+            values = None
+        return cls(offsets, symbols, targets, suffixes, outputs,
+                   keyword_ids, keywords, case_insensitive, binary, values,
+                   normalize, word_boundaries, word_characters)
+
+    @classmethod
+    def open(cls, path):
+        '''
+        Memory maps a file written by save(). The arrays are used directly
+        from the mapping without copying or deserializing them, so the
+        pages are shared between all processes that open the same file.
+        Custom word characters are not stored in the file.
+        '''
+        with open(path, 'rb') as automaton_file:
+            mapped = mmap.mmap(automaton_file.fileno(), 0,
+                               access=mmap.ACCESS_READ)
+        try:
+            view = memoryview(mapped)
+        except TypeError:
+            # mmap doesn't support memoryviews before python 3
+            view = memoryview(mapped[:])
+        if len(view) < HEADER.size:
+            raise ValueError('{0} is not a ahocorapy file.'.format(path))
+        magic, version, flags, state_count, edge_count, keyword_count, \
+            blob_size = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError('{0} is not a ahocorapy file.'.format(path))
+        if version != FORMAT_VERSION:
+            raise ValueError(
+                'Unsupported ahocorapy file version {0}.'.format(version))
+        position = HEADER.size + _padding(HEADER.size)
+        sections = []
+        for code, count in ((TYPECODE, state_count + 1),
+                            (TYPECODE, edge_count),
+                            (TYPECODE, edge_count),
+                            (TYPECODE, state_count),
+                            (TYPECODE, state_count),
+                            (TYPECODE, state_count),
+                            ('q', keyword_count + 1)):
+            size = count * struct.calcsize(code)
+            if position + size > len(view):
+                raise ValueError('{0} is not a ahocorapy file.'.format(path))
+            sections.append(
+                _read_array(view[position:position + size], code))
+            position += size + _padding(size)
+        if position + blob_size > len(view):
+            raise ValueError('{0} is not a ahocorapy file.'.format(path))
+        blob = view[position:position + blob_size]
+        values = None
+        if flags & FLAG_VALUES:
+            position += blob_size + _padding(blob_size)
+            if position > len(view):
+                raise ValueError(
+                    '{0} is not a ahocorapy file.'.format(path))
+            values = _ValueTable(view[position:])
+        offsets, symbols, targets, suffixes, outputs, keyword_ids, \
+            keyword_offsets = sections
+        binary = bool(flags & FLAG_BINARY)
+        automaton = cls(offsets, symbols, targets, suffixes, outputs,
+                        keyword_ids,
+                        _KeywordTable(keyword_offsets, blob, binary),
+                        bool(flags & FLAG_CASE_INSENSITIVE), binary, values,
+                        bool(flags & FLAG_NORMALIZE),
+                        bool(flags & FLAG_WORD_BOUNDARIES), None,
+                        bool(flags & FLAG_MINIMIZED))
+        automaton._mapped = mapped
+        automaton._path = path
+        return automaton
+
+    def save(self, path):
+        '''
+        Writes the automaton to path in a versioned binary format that can
+        be memory mapped by open(). Values of the keywords are stored as
+        JSON. A ValueError is raised if they would be read back differently
+        (e.g. tuples, which become lists, or dicts with int keys) or can't
+        be serialized at all.
+        '''
+        keyword_offsets = array(_typecode('q'), [0])
+        encoded = []
+        size = 0
+        for idx in range(len(self._keywords)):
+            keyword = self._keywords[idx]
+            if not self._binary:
+                keyword = keyword.encode('utf-8')
+            encoded.append(keyword)
+            size += len(keyword)
+            keyword_offsets.append(size)
+        flags = FLAG_CASE_INSENSITIVE if self._case_insensitive else 0
+        if self._binary:
+            flags |= FLAG_BINARY
+        if self._normalize:
+            flags |= FLAG_NORMALIZE
+        if self._word_boundaries:
+            flags |= FLAG_WORD_BOUNDARIES
+        if self._minimized:
+            flags |= FLAG_MINIMIZED
+        encoded_values = None
+        if self._values is not None:
+            flags |= FLAG_VALUES
+            all_values = [self._values[idx]
+                          for idx in range(len(self._values))]
+            try:
+                encoded_values = json.dumps(all_values,
+                                            separators=(',', ':'))
+                kept = json.loads(encoded_values) == all_values
+            except (TypeError, ValueError):
+                kept = False
+            if not kept:
+                raise ValueError('Values that are not kept by JSON' +
+                                 ' cannot be saved.')
+            encoded_values = encoded_values.encode('utf-8')
+        header = HEADER.pack(MAGIC, FORMAT_VERSION, flags, len(self),
+                             len(self._symbols), len(encoded), size)
+        with open(path, 'wb') as automaton_file:
+            automaton_file.write(header)
+            automaton_file.write(b'\0' * _padding(len(header)))
+            for values in (self._offsets, self._symbols, self._targets,
+                           self._suffixes, self._outputs, self._keyword_ids,
+                           keyword_offsets):
+                code = 'q' if values is keyword_offsets else TYPECODE
+                if not isinstance(values, array):
+                    values = array(values.format, values.tobytes())
+                data = _little_endian_bytes(values, code)
+                automaton_file.write(data)
+                automaton_file.write(b'\0' * _padding(len(data)))
+            for keyword in encoded:
+                automaton_file.write(keyword)
+            if encoded_values is not None:
+                automaton_file.write(b'\0' * _padding(size))
+                automaton_file.write(encoded_values)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_mapped', None)
+        state['_depths'] = None
+        state['_keyword_index'] = None
+        state['_path'] = None
+        for name in ('_offsets', '_symbols', '_targets', '_suffixes',
+                     '_outputs', '_keyword_ids'):
+            values = state[name]
+            if not isinstance(values, array):
+                state[name] = array(values.format, values.tobytes())
+        keywords = state['_keywords']
+        state['_keywords'] = [keywords[idx] for idx in range(len(keywords))]
+        values = state['_values']
+        if values is not None:
+            state['_values'] = [values[idx] for idx in range(len(values))]
+        return state
+
+    def __setstate__(self, state):
+        # Pickles written before values were supported have no _values
+        state.setdefault('_values', None)
+        state.setdefault('_normalize', False)
+        state.setdefault('_word_boundaries', False)
+        state.setdefault('_word_characters', None)
+        state.setdefault('_minimized', False)
+        state.setdefault('_depths', None)
+        state.setdefault('_keyword_index', None)
+        self.__dict__.update(state)
+
+    def __len__(self):
+        '''
+        Number of states in the automaton.
+        '''
+        return len(self._keyword_ids)
+
+    def minimized(self):
+        '''
+        Returns an equivalent automaton with all equivalent states merged,
+        like the suffixes of a DAWG. Two states are equivalent if they have
+        the same depth, the same subtrie (the same keyword endings can
+        follow them) and equivalent longest strict suffixes. Then the
+        search visits equivalent states for every text and reports matches
+        of the same lengths. Keyword lists sharing long endings (e.g.
+        domains) shrink a lot.
+        A state of the minimized automaton does not identify a keyword
+        anymore. The matched keyword is looked up by the matched part of
+        the text, so the automaton cannot search streams.
+        '''
+        offsets = self._offsets
+        symbols = self._symbols
+        targets = self._targets
+        suffixes = self._suffixes
+        outputs = self._outputs
+        keyword_ids = self._keyword_ids
+        depths = self._get_depths()
+        state_count = len(self)
+        # Children have higher numbers than their parents, so their
+        # subtries are numbered first.
+        subtries = array(TYPECODE, [0]) * state_count
+        numbers = {}
+        for state in range(state_count - 1, -1, -1):
+            lo = offsets[state]
+            hi = offsets[state + 1]
+            key = (keyword_ids[state] >= 0, tuple(symbols[lo:hi]),
+                   tuple(subtries[target] for target in targets[lo:hi]))
+            subtries[state] = numbers.setdefault(key, len(numbers))
+        # Suffixes are shorter than their states, so they are merged
+        # first. Merged states are numbered in the order of their first
+        # state, which keeps parents before their children.
+        merged = array(TYPECODE, [0]) * state_count
+        numbers = {}
+        first_states = array(TYPECODE)
+        for state in range(state_count):
+            key = (depths[state], subtries[state],
+                   merged[suffixes[state]])
+            number = numbers.setdefault(key, len(numbers))
+            if number == len(first_states):
+                first_states.append(state)
+            merged[state] = number
+        subtries = numbers = None
+
+        new_offsets = array(TYPECODE, [0])
+        new_symbols = array(TYPECODE)
+        new_targets = array(TYPECODE)
+        new_suffixes = array(TYPECODE)
+        new_outputs = array(TYPECODE)
+        new_keyword_ids = array(TYPECODE)
+        for state in first_states:
+            lo = offsets[state]
+            hi = offsets[state + 1]
+            new_symbols.extend(symbols[lo:hi])
+            new_targets.extend(merged[target] for target in targets[lo:hi])
+            new_offsets.append(len(new_symbols))
+            new_suffixes.append(merged[suffixes[state]])
+            new_outputs.append(merged[outputs[state]])
+            new_keyword_ids.append(keyword_ids[state])
+        return CompactAutomaton(
+            new_offsets, new_symbols, new_targets, new_suffixes, new_outputs,
+            new_keyword_ids, self._keywords, self._case_insensitive,
+            self._binary, self._values, self._normalize,
+            self._word_boundaries, self._word_characters, minimized=True)
+
+    def max_keyword_length(self):
+        '''
+        Length of the longest keyword (as stored in the automaton).
+        '''
+        lengths = self._keyword_lengths()
+        if lengths is not None:
+            keyword_ids = self._keyword_ids
+            return max([lengths[state] for state in range(len(self))
+                        if keyword_ids[state] >= 0] or [0])
+        keywords = self._keywords
+        result = 0
+        for idx in range(len(keywords)):
+            result = max(result, len(keywords[idx]))
+        return result
+
+    def _keyword_lengths(self):
+        # The keywords are returned as they were added, folding might have
+        # changed their length in the automaton. The depths of the states
+        # are the lengths then. None if the keywords can be used.
+        if self._case_insensitive or self._normalize or self._minimized:
+            return self._get_depths()
+        return None
+
+    def _word_test(self):
+        # Function telling whether a character is part of a word, None if
+        # matches don't have to be on word boundaries.
+        if not self._word_boundaries:
+            return None
+        return word_character_test(self._binary, self._word_characters)
+
+    def search_all(self, text, cursor=None, offset=0, values=False):
+        '''
+        Same as KeywordTree.search_all, but operating on the flat arrays.
+        cursor and offset allow to continue a search, see
+        KeywordTree._search.
+        '''
+        if self._minimized:
+            return self._identify(
+                self._search_all(text, cursor, offset, True), text, offset,
+                values)
+        return self._search_all(text, cursor, offset, values)
+
+    def _fold_keyword(self):
+        # Function folding a keyword like it is stored in the automaton
+        if self._case_insensitive or self._normalize:
+            return Folding(self._case_insensitive, self._normalize).fold
+        return lambda keyword: keyword
+
+    def _get_keyword_index(self):
+        # 32bit hashes of the keywords as stored in the automaton in
+        # ascending order, with the ids of their keywords. Built on first
+        # use, it needs 8 bytes per keyword instead of a dict holding all of
+        # them (hashes are salted per process, so it is never stored).
+        if self._keyword_index is None:
+            fold = self._fold_keyword()
+            keywords = self._keywords
+            entries = sorted((hash(fold(keywords[keyword_id])) & 0xffffffff,
+                              keyword_id)
+                             for keyword_id in range(len(keywords)))
+            self._keyword_index = (
+                array('I', [key for key, _ in entries]),
+                array(TYPECODE, [keyword_id for _, keyword_id in entries]))
+        return self._keyword_index
+
+    def _keyword_id(self, state, text, start, end):
+        # Id of the keyword matched by text[start:end] in a matching state
+        if not self._minimized:
+            return self._keyword_ids[state]
+        matched = text[start:end]
+        if self._binary and matched.__class__ is not bytes:
+            matched = bytes(matched)
+        hashes, keyword_ids = self._get_keyword_index()
+        key = hash(matched) & 0xffffffff
+        position = bisect_left(hashes, key)
+        if position + 1 == len(hashes) or hashes[position + 1] != key:
+            # The matched text is a keyword, the only one with this hash
+            return keyword_ids[position]
+        fold = self._fold_keyword()
+        keywords = self._keywords
+        while True:
+            keyword_id = keyword_ids[position]
+            if fold(keywords[keyword_id]) == matched:
+                return keyword_id
+            position += 1
+
+    def _identify(self, results, text, offset, values):
+        # Replaces the keywords (and values) of the results of a minimized
+        # automaton, which belong to an arbitrary keyword of the same
+        # length, by the ones of the keyword matched.
+        keywords = self._keywords
+        keyword_values = self._values
+        for _, start, end in results:
+            keyword_id = self._keyword_id(None, text, start - offset,
+                                          end - offset)
+            if values:
+                yield (None if keyword_values is None
+                       else keyword_values[keyword_id], start, end)
+            else:
+                yield (keywords[keyword_id], start)
+
+    def _search_all(self, text, cursor, offset, values):
+        offsets = self._offsets
+        symbols = self._symbols
+        targets = self._targets
+        suffixes = self._suffixes
+        outputs = self._outputs
+        keyword_ids = self._keyword_ids
+        keywords = self._keywords
+        keyword_values = self._values
+        lengths = self._keyword_lengths()
+        is_word = self._word_test()
+        length = len(text) + offset
+        state = 0 if cursor is None else cursor[0]
+        codes = text if self._binary else map(ord, text)
+        for idx, symbol in enumerate(codes, offset):
+            while True:
+                lo = offsets[state]
+                hi = offsets[state + 1]
+                if lo != hi:
+                    found = bisect_left(symbols, symbol, lo, hi)
+                    if found != hi and symbols[found] == symbol:
+                        state = targets[found]
+                        break
+                if state == 0:
+                    break
+                state = suffixes[state]
+            match = state if keyword_ids[state] >= 0 else outputs[state]
+            if match and is_word is not None and idx + 1 < length and \
+                    is_word(text[idx + 1 - offset]):
+                # No keyword ending here ends on a word boundary
+                continue
+            while match:
+                keyword_id = keyword_ids[match]
+                keyword = keywords[keyword_id]
+                start = idx + 1 - (len(keyword) if lengths is None
+                                   else lengths[match])
+                if is_word is not None and start > offset and \
+                        is_word(text[start - offset - 1]):
+                    match = outputs[match]
+                    continue
+                if values:
+                    yield (None if keyword_values is None
+                           else keyword_values[keyword_id], start, idx + 1)
+                else:
+                    yield (keyword, start)
+                match = outputs[match]
+        if cursor is not None:
+            cursor[0] = state
+
+    def contains(self, text):
+        '''
+        Same as KeywordTree.contains, but operating on the flat arrays.
+        '''
+        offsets = self._offsets
+        symbols = self._symbols
+        targets = self._targets
+        suffixes = self._suffixes
+        outputs = self._outputs
+        keyword_ids = self._keyword_ids
+        state = 0
+        codes = text if self._binary else map(ord, text)
+        for symbol in codes:
+            while True:
+                lo = offsets[state]
+                hi = offsets[state + 1]
+                if lo != hi:
+                    found = bisect_left(symbols, symbol, lo, hi)
+                    if found != hi and symbols[found] == symbol:
+                        state = targets[found]
+                        break
+                if state == 0:
+                    break
+                state = suffixes[state]
+            if keyword_ids[state] >= 0 or outputs[state]:
+                return True
+        return False
+
+    def count(self, text, per_keyword=False):
+        '''
+        Same as KeywordTree.count, but operating on the flat arrays.
+        '''
+        if per_keyword and self._minimized:
+            return Counter(keyword for keyword, _ in self.search_all(text))
+        offsets = self._offsets
+        symbols = self._symbols
+        targets = self._targets
+        suffixes = self._suffixes
+        outputs = self._outputs
+        keyword_ids = self._keyword_ids
+        # Counted by keyword id, the keywords are only looked up at the end
+        counts = {}
+        total = 0
+        state = 0
+        codes = text if self._binary else map(ord, text)
+        for symbol in codes:
+            while True:
+                lo = offsets[state]
+                hi = offsets[state + 1]
+                if lo != hi:
+                    found = bisect_left(symbols, symbol, lo, hi)
+                    if found != hi and symbols[found] == symbol:
+                        state = targets[found]
+                        break
+                if state == 0:
+                    break
+                state = suffixes[state]
+            match = state if keyword_ids[state] >= 0 else outputs[state]
+            while match:
+                if per_keyword:
+                    keyword_id = keyword_ids[match]
+                    counts[keyword_id] = counts.get(keyword_id, 0) + 1
+                else:
+                    total += 1
+                match = outputs[match]
+        if not per_keyword:
+            return total
+        keywords = self._keywords
+        return Counter(dict((keywords[keyword_id], occurences)
+                            for keyword_id, occurences in counts.items()))
+
+    def _get_depths(self):
+        # Depth (length of the string) of every state, computed on first
+        # use since only the modes other than OVERLAPPING need it.
+        if self._depths is None:
+            offsets = self._offsets
+            targets = self._targets
+            depths = array(TYPECODE, [0]) * len(self)
+            for state in range(len(self)):
+                depth = depths[state] + 1
+                for pos in range(offsets[state], offsets[state + 1]):
+                    depths[targets[pos]] = depth
+            self._depths = depths
+        return self._depths
+
+    def prepare(self):
+        '''
+        Computes everything that is otherwise computed on first use, so that
+        searching doesn't change the automaton anymore (see
+        KeywordTree.freeze()).
+        '''
+        self._get_depths()
+        if self._minimized:
+            self._get_keyword_index()
+        if isinstance(self._values, _ValueTable):
+            self._values._decoded()
+
+    def search_with_mode(self, text, mode, values=False):
+        '''
+        Same as KeywordTree.search_all with a mode other than OVERLAPPING,
+        but operating on the flat arrays. Keyword ids are the priorities of
+        the keywords.
+        '''
+        if self._minimized:
+            return self._identify(self._search_with_mode(text, mode, True),
+                                  text, 0, values)
+        return self._search_with_mode(text, mode, values)
+
+    def _search_with_mode(self, text, mode, values):
+        binary = self._binary
+        offsets = self._offsets
+        symbols = self._symbols
+        targets = self._targets
+        suffixes = self._suffixes
+        outputs = self._outputs
+        keyword_ids = self._keyword_ids
+        keywords = self._keywords
+        keyword_values = self._values
+        depths = self._get_depths()
+        is_word = self._word_test()
+        leftmost_first = mode == LEFTMOST_FIRST
+        non_overlapping = mode == NON_OVERLAPPING
+        length = len(text)
+        idx = 0
+        state = 0
+        # Best match found so far (0 if none), reported as soon as no match
+        # starting further left can be found anymore.
+        best = 0
+        best_start = 0
+        best_end = 0
+        while True:
+            if idx < length:
+                symbol = text[idx] if binary else ord(text[idx])
+                idx += 1
+                while True:
+                    lo = offsets[state]
+                    hi = offsets[state + 1]
+                    if lo != hi:
+                        found = bisect_left(symbols, symbol, lo, hi)
+                        if found != hi and symbols[found] == symbol:
+                            state = targets[found]
+                            break
+                    if state == 0:
+                        break
+                    state = suffixes[state]
+                if not best or idx - depths[state] <= best_start:
+                    # Only the longest keyword ending here can start further
+                    # left than best, the rest of the output chain is
+                    # skipped.
+                    match = state if keyword_ids[state] >= 0 \
+                        else outputs[state]
+                    if match and is_word is not None:
+                        if idx < length and is_word(text[idx]):
+                            continue
+                        # The longest keyword starting on a word boundary
+                        while match and idx > depths[match] and \
+                                is_word(text[idx - depths[match] - 1]):
+                            match = outputs[match]
+                    if not match:
+                        continue
+                    start = idx - depths[match]
+                    if non_overlapping:
+                        best = match
+                        best_start = start
+                        best_end = idx
+                    elif (not best or start < best_start or
+                          (start == best_start and
+                           (not leftmost_first or
+                            self._keyword_id(match, text, start, idx) <
+                            self._keyword_id(best, text, best_start,
+                                             best_end)))):
+                        best = match
+                        best_start = start
+                        best_end = idx
+                        continue
+                    else:
+                        continue
+            elif not best:
+                break
+            keyword_id = keyword_ids[best]
+            if values:
+                yield (None if keyword_values is None
+                       else keyword_values[keyword_id], best_start, best_end)
+            else:
+                yield (keywords[keyword_id], best_start)
+            # Continue right after the reported match
+            idx = best_end
+            state = 0
+            best = 0
+
+    def search_many(self, texts, first_only=False, values=False):
+        '''
+        Same as KeywordTree.search_many (or KeywordTree.search_one_many if
+        first_only is true), but operating on the flat arrays.
+        '''
+        if values or self._minimized:
+            return self._search_each(texts, first_only, values)
+        return self._search_many(texts, first_only)
+
+    def _search_each(self, texts, first_only, values):
+        for doc_index, text in enumerate(texts):
+            for result in self.search_all(text, values=values):
+                yield (doc_index,) + result
+                if first_only:
+                    break
+
+    def _search_many(self, texts, first_only):
+        binary = self._binary
+        offsets = self._offsets
+        symbols = self._symbols
+        targets = self._targets
+        suffixes = self._suffixes
+        outputs = self._outputs
+        keyword_ids = self._keyword_ids
+        keywords = self._keywords
+        lengths = self._keyword_lengths()
+        is_word = self._word_test()
+        for doc_index, text in enumerate(texts):
+            length = len(text)
+            state = 0
+            codes = text if binary else map(ord, text)
+            for idx, symbol in enumerate(codes):
+                while True:
+                    lo = offsets[state]
+                    hi = offsets[state + 1]
+                    if lo != hi:
+                        found = bisect_left(symbols, symbol, lo, hi)
+                        if found != hi and symbols[found] == symbol:
+                            state = targets[found]
+                            break
+                    if state == 0:
+                        break
+                    state = suffixes[state]
+                match = state if keyword_ids[state] >= 0 else outputs[state]
+                if match and is_word is not None and idx + 1 < length and \
+                        is_word(text[idx + 1]):
+                    continue
+                while match:
+                    keyword = keywords[keyword_ids[match]]
+                    start = idx + 1 - (len(keyword) if lengths is None
+                                       else lengths[match])
+                    if is_word is not None and start > 0 and \
+                            is_word(text[start - 1]):
+                        match = outputs[match]
+                        continue
+                    yield (doc_index, keyword, start)
+                    if first_only:
+                        break
+                    match = outputs[match]
+                else:
+                    continue
+                # Only reached if the first keyword of the text was found
+                break
+
+
+class _KeywordTable(object):
+    '''
+    Read only list of keywords backed by a memory mapped utf-8 blob.
+    Keywords are only decoded when they are actually matched. Keywords of
+    binary automatons are returned as bytes.
+    '''
+
+    def __init__(self, offsets, blob, binary=False):
+        self._offsets = offsets
+        self._blob = blob
+        self._binary = binary
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, idx):
+        keyword = self._blob[self._offsets[idx]:self._offsets[idx + 1]]\
+            .tobytes()
+        if self._binary:
+            return keyword
+        return keyword.decode('utf-8')
+
+
+class _ValueTable(object):
+    '''
+    Read only list of values backed by a memory mapped JSON blob. The blob
+    is only decoded when the first value is accessed.
+    '''
+
+    def __init__(self, blob):
+        self._blob = blob
+        self._values = None
+
+    def _decoded(self):
+        if self._values is None:
+            self._values = json.loads(self._blob.tobytes().decode('utf-8'))
+        return self._values
+
+    def __len__(self):
+        return len(self._decoded())
+
+    def __getitem__(self, idx):
+        return self._decoded()[idx]
@@ -0,0 +1,188 @@
+'''
+Dense transition table for finalized trees with shortcut transitions.
+
+Every character (or byte) occurring in a keyword gets its own symbol class,
+all other characters share one class, which leads back to the zero state
+from every state. Texts are translated to class numbers at C speed
+(str.translate and bytes.translate) and every state has a row with the
+next row for every class, so following a transition is a single list
+lookup instead of hashing the character.
+'''
+
+from builtins import chr, map, object, range
+from collections import Counter
+
+from ahocorapy.folding import FROZEN_CHARACTERS, MAX_CACHED_CHARACTERS
+
+
+class _ClassTable(dict):
+    '''
+    Translation table for str.translate, mapping the code of every
+    character to the character whose code is its class. Characters that
+    are not part of any keyword are added on first use, unless the table
+    is frozen.
+    '''
+
+    def __init__(self, classes, other):
+        super(_ClassTable, self).__init__(
+            (ord(symbol), chr(symbol_class))
+            for symbol, symbol_class in classes.items())
+        self._other = chr(other)
+        self._frozen = False
+
+    def freeze(self):
+        for code in range(FROZEN_CHARACTERS):
+            self[code]
+        self._frozen = True
+
+    def __missing__(self, code):
+        if not self._frozen and len(self) < MAX_CACHED_CHARACTERS:
+            self[code] = self._other
+        return self._other
+
+
+class DenseTable(object):
+    '''
+    Rows of all states of a finalized tree with shortcuts, stored in one
+    flat list. The row of a state starts at its identifier times the width
+    of the rows. Its first entry is the first state on the suffix chain
+    (including the state itself) that matches a keyword, or None, followed
+    by the starts of the next rows by class (classes are numbered from 1).
+    Rows of identifiers without a state (e.g. removed ones) are never
+    reached.
+    '''
+
+    def __init__(self, zero_state, state_count, binary=False):
+        '''
+        @param zero_state: Zero state of a finalized tree with shortcuts.
+        @param state_count: Number of identifiers given to states so far.
+        '''
+        states = []
+        alphabet = set()
+        to_process = [zero_state]
+        while to_process:
+            state = to_process.pop()
+            states.append(state)
+            for symbol, child in state.transitions.items():
+                if child.parent is state:
+                    alphabet.add(symbol)
+                    to_process.append(child)
+        classes = dict((symbol, symbol_class) for symbol_class, symbol
+                       in enumerate(sorted(alphabet), 1))
+        other = len(classes) + 1
+        width = other + 1
+        self._binary = binary
+        self._width = width
+        if not binary:
+            self._table = _ClassTable(classes, other)
+        elif other < 256:
+            self._table = bytes(bytearray(
+                classes.get(symbol, other) for symbol in range(256)))
+        else:
+            # Every byte occurs in the keywords, the classes 1 to 256 don't
+            # fit into a translation table for bytes.
+            self._table = [classes[symbol] for symbol in range(256)]
+
+        # Transitions not in a row of a finalized tree are the ones of the
+        # zero state (or lead to the zero state).
+        template = [0] * width
+        for symbol, child in zero_state.transitions.items():
+            template[classes[symbol]] = child.identifier * width
+        rows = template * state_count
+        self._states = [None] * state_count
+        for state in states:
+            self._states[state.identifier] = state
+            start = state.identifier * width
+            for symbol, next_state in state.transitions.items():
+                rows[start + classes[symbol]] = next_state.identifier * width
+            rows[start] = state if state.success else state.output
+        self._rows = rows
+
+    def freeze(self):
+        '''
+        Translating doesn't change the table anymore afterwards (see
+        KeywordTree.freeze()).
+        '''
+        if not self._binary:
+            self._table.freeze()
+
+    def translate(self, text):
+        '''
+        @return: Iterable of the class numbers of the symbols of text.
+        '''
+        if self._binary:
+            if isinstance(text, memoryview):
+                text = text.tobytes()
+            if isinstance(self._table, list):
+                return map(self._table.__getitem__, bytearray(text))
+            return text.translate(self._table)
+        return map(ord, text.translate(self._table))
+
+    def row(self, state):
+        '''
+        @return: Start of the row of state.
+        '''
+        return state.identifier * self._width
+
+    def search_all(self, text, cursor=None, offset=0, values=False,
+                   is_word=None):
+        '''
+        Same as KeywordTree._search_all, but following the rows. cursor
+        holds a state (not a row), like for the other search methods.
+        '''
+        rows = self._rows
+        length = len(text) + offset
+        row = 0 if cursor is None else self.row(cursor[0])
+        for idx, symbol in enumerate(self.translate(text), offset):
+            row = rows[row + symbol]
+            state = rows[row]
+            if state is None:
+                continue
+            if is_word is not None and idx + 1 < length and \
+                    is_word(text[idx + 1 - offset]):
+                # No keyword ending here ends on a word boundary
+                continue
+            while state is not None:
+                if is_word is not None and idx >= state.depth + offset and \
+                        is_word(text[idx - state.depth - offset]):
+                    state = state.output
+                    continue
+                if values:
+                    yield (state.value, idx + 1 - state.depth, idx + 1)
+                else:
+                    yield (state.matched_keyword, idx + 1 - state.depth)
+                state = state.output
+        if cursor is not None:
+            cursor[0] = self._states[row // self._width]
+
+    def contains(self, text):
+        '''
+        Same as KeywordTree.contains, but following the rows.
+        '''
+        rows = self._rows
+        row = 0
+        for symbol in self.translate(text):
+            row = rows[row + symbol]
+            if rows[row] is not None:
+                return True
+        return False
+
+    def count(self, text, per_keyword=False):
+        '''
+        Same as KeywordTree.count, but following the rows.
+        '''
+        rows = self._rows
+        counts = {}
+        total = 0
+        row = 0
+        for symbol in self.translate(text):
+            row = rows[row + symbol]
+            state = rows[row]
+            while state is not None:
+                if per_keyword:
+                    keyword = state.matched_keyword
+                    counts[keyword] = counts.get(keyword, 0) + 1
+                else:
+                    total += 1
+                state = state.output
+        return Counter(counts) if per_keyword else total
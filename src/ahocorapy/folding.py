@@ -0,0 +1,234 @@
+'''
+Folding of keywords and texts for case insensitive and normalized trees.
+
+Texts are folded before they are searched and the offsets of the matches
+are translated back, so they always refer to the original text, also if
+folding changed the length of the text.
+'''
+
+from array import array
+from builtins import chr, map, object, range
+from itertools import chain, repeat
+import sys
+import unicodedata
+
+
+# Typecode of the arrays of offsets, 'q' (64bit) doesn't exist before
+# python 3.3
+OFFSET_TYPECODE = 'q' if sys.version_info >= (3, 3) else 'l'
+
+# Caches of characters (see _FoldTable and dense._ClassTable) stop growing
+# at this size.
+MAX_CACHED_CHARACTERS = 65536
+
+# Characters cached by the tables of frozen trees (up to the end of the
+# two byte range of utf-8, i.e. latin, greek, cyrillic, hebrew, arabic,
+# ...). Other characters are looked up again every time they occur.
+FROZEN_CHARACTERS = 0x800
+
+# Bytes are sequences of characters before python 3. Binary trees work on
+# byte values, so their keywords and texts are copied to bytearrays there.
+BYTES_ARE_CHARACTERS = sys.version_info[0] < 3
+
+
+def byte_values(data):
+    '''
+    @return: bytes, bytearray or memoryview as a sequence of byte values.
+    '''
+    if BYTES_ARE_CHARACTERS and not isinstance(data, bytearray):
+        return bytearray(data)
+    return data
+
+
+def lower(text):
+    '''
+    Lowercases str, bytes and bytearray. memoryviews are copied to bytes.
+    '''
+    if isinstance(text, memoryview):
+        text = text.tobytes()
+    return text.lower()
+
+
+class _FoldTable(dict):
+    '''
+    Cache of the folded form of the characters seen so far. Nothing is
+    added once it is frozen.
+    '''
+
+    def __init__(self, case_insensitive):
+        super(_FoldTable, self).__init__()
+        self._case_insensitive = case_insensitive
+        self._frozen = False
+
+    def freeze(self):
+        for code in range(FROZEN_CHARACTERS):
+            self[chr(code)]
+        self._frozen = True
+
+    def __missing__(self, char):
+        if isinstance(char, bytes):
+            # Characters of str before python 3
+            char = char.decode('latin-1')
+        # Compatibility decomposition (e.g. ligatures, full width forms)
+        # without the combining marks (diacritics)
+        folded = ''.join(
+            part for part in unicodedata.normalize('NFKD', char)
+            if not unicodedata.combining(part))
+        if self._case_insensitive:
+            folded = folded.lower()
+        if not self._frozen and len(self) < MAX_CACHED_CHARACTERS:
+            self[char] = folded
+        return folded
+
+
+class Folding(object):
+    '''
+    Folds keywords and texts of a tree. Case insensitive trees lowercase
+    them, normalized trees fold every character to its compatibility
+    decomposition without diacritics (and lowercase it, if the tree is
+    case insensitive, too).
+    '''
+
+    def __init__(self, case_insensitive=False, normalize=False):
+        self._case_insensitive = case_insensitive
+        self._normalize = normalize
+        self._folds = _FoldTable(case_insensitive) if normalize else None
+
+    def freeze(self):
+        '''
+        Folding doesn't change this object anymore afterwards, so that it
+        can be used by several threads (see KeywordTree.freeze()).
+        '''
+        if self._folds is not None:
+            self._folds.freeze()
+
+    def fold(self, keyword):
+        '''
+        @return: The folded keyword.
+        '''
+        if self._normalize:
+            return ''.join(map(self._folds.__getitem__, keyword))
+        return keyword.lower()
+
+    def fold_text(self, text):
+        '''
+        @return: 2-Tuple of the folded text and an array holding the index
+                 in text of every character of the folded text. The array
+                 is None if every character was folded to exactly one
+                 character, i.e. offsets don't have to be translated.
+        '''
+        if not self._normalize:
+            folded = lower(text)
+            if len(folded) == len(text):
+                # Lowercasing never removes characters, so no character
+                # has been expanded either.
+                return folded, None
+            pieces = [char.lower() for char in text]
+        else:
+            pieces = list(map(self._folds.__getitem__, text))
+            folded = ''.join(pieces)
+            if len(folded) == len(text) and \
+                    (not pieces or max(map(len, pieces)) == 1):
+                return folded, None
+        origins = array(OFFSET_TYPECODE, chain.from_iterable(
+            map(repeat, range(len(text)), map(len, pieces))))
+        return folded, origins
+
+    def fold_texts(self, texts, origins_by_doc):
+        '''
+        Folds texts one by one. origins_by_doc maps the index of the text
+        folded last to its origins, if they have to be translated. Older
+        entries are removed, since all results of a text have been reported
+        before the next text is searched.
+        @return: Generator of the folded texts.
+        '''
+        for doc_index, text in enumerate(texts):
+            folded, origins = self.fold_text(text)
+            origins_by_doc.clear()
+            if origins is not None:
+                origins_by_doc[doc_index] = origins
+            yield folded
+
+
+def to_original_offsets(results, origins, offset, values):
+    '''
+    Translates the offsets of results found in a folded text (see
+    Folding.fold_text) back to offsets in the original text. Matches
+    must not start before the folded text (see chunk_to_original_offsets
+    for streams).
+    @param offset: Offset the results have been shifted by.
+    @param values: True if the results contain endindices.
+    '''
+    for result in results:
+        yield _to_original_offsets(result, 1, origins, offset, values)
+
+
+def chunk_to_original_offsets(results, origins, offset, values, history):
+    '''
+    Like to_original_offsets for the results of a chunk of a stream, which
+    starts at offset in the stream. Matches starting in previous chunks are
+    translated with history (see chunk_history). Without history (e.g. for
+    a Scanner continuing from a stored state) they are assumed to start
+    where they would without folding.
+    @param origins: See Folding.fold_text, can be None.
+    '''
+    for result in results:
+        start = result[1] - offset
+        if start >= 0:
+            start = offset + (start if origins is None else origins[start])
+        elif -start <= len(history):
+            start = history[start]
+        else:
+            start += offset
+        if values:
+            end = result[2] - offset - 1
+            end = offset + 1 + (end if origins is None else origins[end])
+            yield (result[0], start, end)
+        else:
+            yield (result[0], start)
+
+
+def chunk_history(history, origins, offset, length, keep):
+    '''
+    @param history: Offsets in the stream of the last folded characters
+                    before the chunk.
+    @param length: Length of the folded chunk.
+    @param keep: Number of folded characters whose offsets are kept, i.e.
+                 the furthest a later match can start before the end of
+                 the chunk.
+    @return: Array with the offsets in the stream of the last keep folded
+             characters up to the end of the chunk.
+    '''
+    result = array(OFFSET_TYPECODE)
+    if keep > length:
+        result.extend(history[max(len(history) - keep + length, 0):])
+    first = max(length - keep, 0)
+    if origins is None:
+        result.extend(range(offset + first, offset + length))
+    else:
+        result.extend(offset + origin for origin in origins[first:length])
+    return result
+
+
+def many_to_original_offsets(results, origins_by_doc, values):
+    '''
+    Like to_original_offsets for the results of KeywordTree.search_many,
+    origins_by_doc is filled by Folding.fold_texts.
+    '''
+    for result in results:
+        origins = origins_by_doc.get(result[0])
+        if origins is not None:
+            result = _to_original_offsets(result, 2, origins, 0, values)
+        yield result
+
+
+def _to_original_offsets(result, first, origins, offset, values):
+    # first is the position of the startindex in result
+    start = result[first] - offset
+    if start >= 0:
+        start = origins[start]
+    start += offset
+    if values:
+        end = origins[result[first + 1] - offset - 1] + 1 + offset
+        return result[:first] + (start, end)
+    return result[:first] + (start,)
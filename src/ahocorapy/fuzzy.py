@@ -0,0 +1,154 @@
+'''
+Approximate keyword matching for KeywordTree.search_fuzzy.
+
+A keyword that occurs with at most k edits contains at least one of k + 1
+disjoint pieces of it without any edit (pigeonhole principle). The pieces
+of all keywords are searched exactly with an automaton and only around the
+pieces found the edit distance is computed.
+'''
+
+from builtins import object, range
+
+
+def split_pieces(keyword, max_edits):
+    '''
+    Splits keyword into max_edits + 1 pieces of (almost) equal length.
+    @return: List of 2-Tuples with the piece and its offset in keyword.
+    '''
+    count = max_edits + 1
+    pieces = []
+    for idx in range(count):
+        start = idx * len(keyword) // count
+        end = (idx + 1) * len(keyword) // count
+        pieces.append((keyword[start:end], start))
+    return pieces
+
+
+def _edit_distance(keyword, text, start, max_edits):
+    # Smallest Levenshtein distance between keyword and a text starting at
+    # start, with the end of that text. None if it exceeds max_edits.
+    if start > len(text):
+        return None
+    width = min(len(keyword) + max_edits, len(text) - start)
+    row = list(range(width + 1))
+    for idx in range(len(keyword)):
+        char = keyword[idx]
+        previous = row
+        row = [idx + 1]
+        for column in range(1, width + 1):
+            cost = previous[column - 1]
+            if text[start + column - 1] != char:
+                cost = min(cost, previous[column], row[column - 1]) + 1
+            row.append(cost)
+        if min(row) > max_edits:
+            return None
+    distance = min(row)
+    if distance > max_edits:
+        return None
+    # The longest text with that distance, e.g. viagrra (not viagr) for
+    # viagra
+    return distance, start + width - row[::-1].index(distance)
+
+
+def _hamming_distance(keyword, text, start, max_edits):
+    end = start + len(keyword)
+    if end > len(text):
+        return None
+    distance = 0
+    for idx in range(len(keyword)):
+        if keyword[idx] != text[start + idx]:
+            distance += 1
+            if distance > max_edits:
+                return None
+    return distance, end
+
+
+class FuzzyMatcher(object):
+    '''
+    Searches the keywords of a tree with at most max_edits edits. Created
+    and cached by KeywordTree.search_fuzzy.
+    '''
+
+    def __init__(self, piece_tree, max_edits, substitutions_only,
+                 max_keyword_length):
+        '''
+        @param piece_tree: Finalized KeywordTree of the pieces (see
+                           split_pieces) of all keywords. The value of a
+                           piece is a list of 4-Tuples with the folded
+                           keyword, the keyword, its value and the offset of
+                           the piece in the keyword.
+        '''
+        self._piece_tree = piece_tree
+        self._max_edits = max_edits
+        # Matches overlapping an occurence start at most this far before
+        # its pieces
+        self._horizon = 2 * (max_keyword_length + 2 * max_edits)
+        self._distance = _hamming_distance if substitutions_only \
+            else _edit_distance
+
+    def freeze(self):
+        '''
+        See KeywordTree.freeze().
+        '''
+        self._piece_tree.freeze()
+
+    def search(self, text):
+        '''
+        A match of a keyword is reported at the start where its distance is
+        smallest: it is left out if a match of the same keyword overlapping
+        it has a smaller distance, or the same (non zero) distance and
+        starts earlier.
+        @return: Generator of 5-Tuples with keyword, value, startindex,
+                 endindex and distance.
+        '''
+        max_edits = self._max_edits
+        # Distances by keyword and start. Every piece of a keyword can find
+        # the same occurence, so they are only computed once.
+        distances = {}
+        reported = set()
+        limit = 1024
+        for occurences, piece_start, _ in self._piece_tree.search_all(
+                text, values=True):
+            if len(distances) > limit:
+                # Occurences this far back cannot be found again
+                oldest = piece_start - self._horizon
+                distances = dict(entry for entry in distances.items()
+                                 if entry[0][1] >= oldest)
+                reported = set(entry for entry in reported
+                               if entry[1] >= oldest)
+                limit = max(limit, 2 * len(distances))
+            for folded, keyword, value, offset in occurences:
+                center = piece_start - offset
+                for start in range(max(center - max_edits, 0),
+                                   center + max_edits + 1):
+                    if (folded, start) in reported:
+                        continue
+                    found = self._distance_at(distances, folded, text, start)
+                    if found is not None and \
+                            self._is_best(distances, folded, text, start,
+                                          found):
+                        reported.add((folded, start))
+                        yield (keyword, value, start, found[1], found[0])
+
+    def _distance_at(self, distances, folded, text, start):
+        key = (folded, start)
+        if key not in distances:
+            distances[key] = self._distance(folded, text, start,
+                                            self._max_edits)
+        return distances[key]
+
+    def _is_best(self, distances, folded, text, start, found):
+        distance, end = found
+        # Matches of the keyword overlapping text[start:end]
+        for other_start in range(max(start - len(folded) - self._max_edits,
+                                     0), end):
+            if other_start == start:
+                continue
+            other = self._distance_at(distances, folded, text, other_start)
+            if other is None or other[1] <= start:
+                continue
+            if other[0] < distance or \
+                    (other[0] == distance and distance and
+                     other_start < start):
+                return False
+        return True
@@ -10,12 +10,27 @@ Created on Jan 5, 2016
 @author: Frederik Petersen (fp@abusix.com)
 '''
 
-from builtins import object
+from array import array
+from builtins import chr, map, object
+from codecs import iterdecode
+from collections import Counter
+from operator import attrgetter, itemgetter
+
+from ahocorapy.compact import CompactAutomaton, LEFTMOST_FIRST, \
+    LEFTMOST_LONGEST, MODES, NON_OVERLAPPING, OVERLAPPING, word_character_test
+from ahocorapy.dense import DenseTable
+from ahocorapy.fuzzy import FuzzyMatcher, split_pieces
+from ahocorapy.folding import BYTES_ARE_CHARACTERS, byte_values, \
+    chunk_history, chunk_to_original_offsets, Folding, \
+    many_to_original_offsets, OFFSET_TYPECODE, to_original_offsets
+from ahocorapy.patterns import Pattern, PatternFactor, verify_patterns
+from ahocorapy.prefilter import Prefilter
 
 
 class State(object):
     __slots__ = ['identifier', 'symbol', 'success', 'transitions', 'parent',
-                 'matched_keyword', 'longest_strict_suffix']
+                 'matched_keyword', 'value', 'priority', 'depth',
+                 'longest_strict_suffix', 'output']
 
     def __init__(self, identifier, symbol=None,  parent=None, success=False):
         self.symbol = symbol
@@ -24,7 +39,14 @@ class State(object):
         self.parent = parent
         self.success = success
         self.matched_keyword = None
+        self.value = None
+        # Position of the keyword in the order of addition
+        self.priority = None
+        self.depth = 0 if parent is None else parent.depth + 1
         self.longest_strict_suffix = None
+        # Next state on the suffix chain that matches a keyword, None if
+        # there is none
+        self.output = None
 
     def __str__(self):
         transitions_as_string = ','.join(
@@ -34,37 +56,269 @@ class State(object):
 
 class KeywordTree(object):
 
-    def __init__(self, case_insensitive=False):
+    def __init__(self, case_insensitive=False, shortcuts=True, binary=False,
+                 encoding='utf-8', normalize=False, word_boundaries=False,
+                 word_characters=None):
         '''
         @param case_insensitive: If true, case will be ignored when searching.
                                  Setting this to true will have a positive
                                  impact on performance.
                                  Defaults to false.
+        @param shortcuts: If true, finalize() copies the transitions of the
+                          longest strict suffix into every state, so that
+                          searching only has to follow transitions. If false,
+                          only the transitions of the trie and the suffix
+                          links are kept and suffix links are followed
+                          during the search. This needs a lot less memory
+                          for big alphabets, but searching is slower.
+                          Defaults to true.
+        @param binary: If true, the tree searches bytes, bytearrays and
+                       memoryviews instead of str, without decoding them.
+                       Keywords are added as bytes and found keywords are
+                       returned as bytes, startindices are byte offsets.
+                       Defaults to false.
+        @param encoding: Only used when binary is true. str keywords are
+                         encoded with this encoding when they are added.
+                         Defaults to utf-8.
+        @param normalize: If true, keywords and texts are folded character
+                          by character to their compatibility decomposition
+                          without diacritics, e.g. the ligature fi (U+FB01)
+                          matches 'fi' and e with acute (U+00E9) matches
+                          'e'. Combine with case_insensitive to ignore
+                          case, too. Reported offsets always refer to the
+                          original text. Not supported by binary trees.
+                          Defaults to false.
+        @param word_boundaries: If true, only matches on word boundaries are
+                                reported, i.e. matches neither preceded nor
+                                followed by a word character. Candidates
+                                inside longer words are rejected while
+                                scanning. Not supported by search_stream
+                                and scanner.
+                                Defaults to false.
+        @param word_characters: Only used when word_boundaries is true. str
+                                (or bytes for binary trees) of the
+                                characters words consist of.
+                                Defaults to alphanumeric characters and '_'
+                                (ASCII only for binary trees).
         @param over_allocation: Determines how big initial transition arrays
                                 are and how much space is allocated in addition
                                 to what is essential when array needs to be
                                 resized. Default value 2 seemed to be sweet
                                 spot for memory as well as cpu.
         '''
+        if binary and normalize:
+            raise ValueError('Binary trees cannot be normalized.')
         self._zero_state = State(0)
         self._counter = 1
+        self._keyword_counter = 0
         self._finalized = False
         self._case_insensitive = case_insensitive
+        self._shortcuts = shortcuts
+        self._binary = binary
+        self._encoding = encoding
+        self._normalize = normalize
+        self._folding = self._create_folding()
+        self._word_boundaries = word_boundaries
+        if word_characters is not None:
+            if binary and not isinstance(word_characters, bytes):
+                word_characters = word_characters.encode(encoding)
+            if self._folding is not None:
+                # Compared with the folded text
+                word_characters = self._folding.fold(word_characters)
+        self._word_characters = word_characters
+        self._is_word = self._create_word_test()
+        self._has_patterns = False
+        self._fuzzy_matchers = {}
+        self._dense = False
+        self._dense_table = None
+        self._prefilter = False
+        self._prefilter_searcher = None
+        self._frozen = False
+        self._compact = None
+        self._states_by_identifier = None
+        self._identifiers = None
+        self._suffix_children = None
+        self._parents_by_symbol = None
+
+    @classmethod
+    def from_keywords(cls, keywords, presorted=False, compact=False,
+                      minimize=False, **kwargs):
+        '''
+        Builds and finalizes a tree from an iterable of keywords in one go.
+        Every keyword shares a prefix with the previous one. For sorted
+        keywords the states of the rest of the keyword cannot exist yet, so
+        they are created without looking up any transitions.
+        @param keywords: Iterable of keywords, e.g. a generator over the
+                         lines of a file. Items can also be 2-Tuples of
+                         keyword and value (see add()).
+        @param presorted: If true, the keywords are consumed one by one as
+                          they come, without keeping them in memory.
+                          Keywords that are out of order are still added
+                          correctly, just slower. If false, all keywords are
+                          sorted first.
+                          Defaults to false.
+        @param compact: Passed on to finalize().
+        @param minimize: Passed on to finalize().
+        @param kwargs: Passed on to the constructor (case_insensitive,
+                       shortcuts, ...).
+        @return: The finalized KeywordTree.
+        '''
+        kwtree = cls(**kwargs)
+        normalized = kwtree._normalize_keywords(keywords)
+        if not presorted:
+            normalized = sorted(normalized, key=itemgetter(0))
+        kwtree._build_from_sorted(normalized)
+        kwtree.finalize(compact, minimize)
+        return kwtree
+
+    def _create_folding(self):
+        if self._case_insensitive or self._normalize:
+            return Folding(self._case_insensitive, self._normalize)
+        return None
+
+    def _create_word_test(self):
+        if self._word_boundaries:
+            return word_character_test(self._binary, self._word_characters)
+        return None
+
+    def _fold_text(self, text):
+        # Returns the folded text and the offsets of its characters in text
+        # (None if they don't have to be translated), see Folding.fold_text
+        origins = None
+        if self._folding is not None:
+            text, origins = self._folding.fold_text(text)
+        if self._binary:
+            text = byte_values(text)
+        return text, origins
+
+    def _fold_keyword(self, keyword):
+        # Keyword as it is stored in the trie
+        if self._binary and not isinstance(keyword, bytes):
+            keyword = keyword.encode(self._encoding)
+        if self._folding is not None:
+            keyword = self._folding.fold(keyword)
+        if self._binary:
+            keyword = byte_values(keyword)
+        return keyword
+
+    def _build_from_sorted(self, normalized):
+        counter = self._counter
+        path = [self._zero_state]
+        previous = None
+        in_order = True
+        for keyword, original_keyword, value, priority in normalized:
+            common = 0
+            if previous is not None:
+                limit = min(len(keyword), len(previous))
+                while common < limit and keyword[common] == previous[common]:
+                    common += 1
+                if in_order and keyword < previous:
+                    # From now on the states of the rest of a keyword
+                    # might exist already.
+                    in_order = False
+            del path[common + 1:]
+            current_state = path[common]
+            for char in keyword[common:]:
+                next_state = None
+                if not in_order:
+                    next_state = current_state.transitions.get(char)
+                if next_state is None:
+                    next_state = State(counter, char, current_state)
+                    counter += 1
+                    current_state.transitions[char] = next_state
+                current_state = next_state
+                path.append(current_state)
+            if not current_state.success:
+                current_state.priority = priority
+            current_state.success = True
+            current_state.matched_keyword = original_keyword
+            current_state.value = value
+            previous = keyword
+        self._counter = counter
+
+    def _normalize_keywords(self, keywords):
+        # Yields (keyword as stored in the trie, keyword as returned by the
+        # search, value, priority), like add() does it.
+        binary = self._binary
+        encoding = self._encoding
+        for keyword in keywords:
+            value = None
+            if isinstance(keyword, tuple):
+                keyword, value = keyword
+            if binary and not isinstance(keyword, bytes):
+                keyword = keyword.encode(encoding)
+            original_keyword = keyword
+            keyword = self._fold_keyword(keyword)
+            if len(keyword) > 0:
+                priority = self._keyword_counter
+                self._keyword_counter += 1
+                yield keyword, original_keyword, value, priority
 
-    def add(self, keyword):
+    def add(self, keyword, value=None):
         '''
         Add a keyword to the tree.
-        Can only be used before finalize() has been called.
-        Keyword should be str or unicode.
+        Can also be used after finalize() has been called (except for
+        compact trees). Only the suffix links and shortcut transitions
+        affected by the new keyword are repaired then. Searching while
+        keywords are added is not supported.
+        Keyword should be str or unicode (or bytes for binary trees).
+        @param value: Payload of the keyword (e.g. a rule id or a dict with
+                      category and severity), reported instead of the
+                      keyword by the search methods if values is true.
+                      Adding the same keyword again replaces the value.
+                      Defaults to None.
         '''
-        if self._finalized:
-            raise ValueError('KeywordTree has been finalized.' +
+        self._check_not_frozen()
+        if self._compact is not None:
+            raise ValueError('KeywordTree is compact.' +
                              ' No more keyword additions allowed')
+        if self._binary and not isinstance(keyword, bytes):
+            keyword = keyword.encode(self._encoding)
         original_keyword = keyword
-        if self._case_insensitive:
-            keyword = keyword.lower()
+        keyword = self._fold_keyword(keyword)
         if len(keyword) <= 0:
             return
+        self._add(keyword, original_keyword, value)
+
+    def add_pattern(self, pattern, value=None):
+        '''
+        Add a pattern to the tree. Patterns are keywords with wildcards:
+        ? matches any character, [abc] and [a-z] one of the characters,
+        [^abc] any other character, {x} marks an optional character (or
+        class) and \\ escapes the next character, e.g. 'v[i1!]agra' or
+        'free?money'.
+        The pattern is not expanded into all the keywords it matches, only
+        its longest run of required characters is added to the tree. Where
+        that is found, the rest of the pattern is verified. Matches of
+        patterns are reported with the pattern as keyword as soon as their
+        required characters are found, so they are not necessarily ordered
+        by their end.
+        Not supported by binary trees and trees with word boundaries.
+        Trees with patterns can't search streams, can only search with
+        mode OVERLAPPING and can't be saved.
+        @param value: See add().
+        '''
+        self._check_not_frozen()
+        if self._compact is not None:
+            raise ValueError('KeywordTree is compact.' +
+                             ' No more keyword additions allowed')
+        if self._binary or self._word_boundaries:
+            raise ValueError('Patterns are not supported by binary trees' +
+                             ' and trees with word boundaries.')
+        fold = self._folding.fold if self._folding is not None \
+            else lambda char: char
+        compiled = Pattern(pattern, value, fold)
+        self._has_patterns = True
+        for factor in compiled.factors:
+            self._add(factor, None, None, compiled)
+
+    def _add(self, keyword, original_keyword, value, pattern=None):
+        self._fuzzy_matchers = {}
+        self._dense_table = None
+        self._prefilter_searcher = None
+        if self._finalized:
+            self._add_to_finalized(keyword, original_keyword, value, pattern)
+            return
         current_state = self._zero_state
         for char in keyword:
             try:
@@ -75,134 +329,1288 @@ class KeywordTree(object):
                 self._counter += 1
                 current_state.transitions[char] = next_state
                 current_state = next_state
-        current_state.success = True
-        current_state.matched_keyword = original_keyword
+        self._set_keyword(current_state, original_keyword, value, pattern)
 
-    def search(self, text):
+    def _set_keyword(self, state, original_keyword, value, pattern=None):
+        if not state.success:
+            state.priority = self._keyword_counter
+            self._keyword_counter += 1
+        factor = state.matched_keyword
+        if pattern is not None or factor.__class__ is PatternFactor:
+            # Keyword and value of the state of a factor are the
+            # PatternFactor, which holds the keyword itself, too.
+            if factor.__class__ is not PatternFactor:
+                factor = PatternFactor(state.success, factor, state.value)
+            if pattern is None:
+                factor.set_keyword(original_keyword, value)
+            else:
+                factor.patterns.append(pattern)
+            original_keyword = value = factor
+        state.success = True
+        state.matched_keyword = original_keyword
+        state.value = value
+
+    def remove(self, keyword):
+        '''
+        Remove a keyword from the tree.
+        Can be used before and after finalize() has been called (except for
+        compact trees). The states of the keyword are kept, so this is
+        cheap, but does not free any memory. After finalize() the output
+        links of the states ending with the keyword are repaired.
+        @return: True if the keyword was in the tree, False otherwise.
+        '''
+        self._check_not_frozen()
+        if self._compact is not None:
+            raise ValueError('KeywordTree is compact.' +
+                             ' No keyword removals allowed')
+        keyword = self._fold_keyword(keyword)
+        if len(keyword) <= 0:
+            return False
+        current_state = self._zero_state
+        for char in keyword:
+            next_state = current_state.transitions.get(char)
+            if next_state is None or next_state.parent is not current_state:
+                return False
+            current_state = next_state
+        if not current_state.success:
+            return False
+        self._fuzzy_matchers = {}
+        self._dense_table = None
+        self._prefilter_searcher = None
+        factor = current_state.matched_keyword
+        if factor.__class__ is PatternFactor:
+            # The state stays, its patterns are still in the tree
+            if not factor.is_keyword:
+                return False
+            factor.clear_keyword()
+            return True
+        current_state.success = False
+        current_state.matched_keyword = None
+        current_state.value = None
+        current_state.priority = None
+        if self._finalized:
+            self._update_outputs([current_state], self._get_suffix_children())
+        return True
+
+    def search(self, text, values=False, mode=OVERLAPPING):
         '''
         Alias for the search_one method
         '''
-        return self.search_one(text)
+        return self.search_one(text, values, mode)
 
-    def search_one(self, text):
+    def search_one(self, text, values=False, mode=OVERLAPPING):
         '''
         Search a text for any occurence of any added keyword.
         Returns when one keyword has been found.
         Can only be called after finalized() has been called.
         O(n) with n = len(text)
+        @param values: See search_all.
+        @param mode: See search_all. With LEFTMOST_FIRST or
+                     LEFTMOST_LONGEST the leftmost keyword is returned.
         @return: 2-Tuple with keyword and startindex in text.
                  Or None if no keyword was found in the text.
         '''
-        result_gen = self.search_all(text)
+        result_gen = self.search_all(text, values, mode)
         try:
             return next(result_gen)
         except StopIteration:
             return None
 
-    def search_all(self, text):
+    def search_all(self, text, values=False, mode=OVERLAPPING):
         '''
         Search a text for all occurences of the added keywords.
         Can only be called after finalized() has been called.
         O(n) with n = len(text)
+        @param values: If true, 3-Tuples with the value of the keyword (see
+                       add()), startindex and endindex (exclusive) are
+                       returned instead of keyword and startindex.
+                       Defaults to false.
+        @param mode: Selects which matches are reported.
+                     OVERLAPPING: All matches, also overlapping ones.
+                     NON_OVERLAPPING: The keyword that ends first (the
+                     longest one, if several end at the same position),
+                     then the search continues after it.
+                     LEFTMOST_LONGEST: The keyword that starts first (the
+                     longest one, if several start at the same position),
+                     then the search continues after it.
+                     LEFTMOST_FIRST: Like LEFTMOST_LONGEST, but of the
+                     keywords starting at the same position the one added
+                     first is reported.
+                     The modes other than OVERLAPPING select the matches
+                     while scanning, without walking the complete suffix
+                     chain at every position.
+                     Defaults to OVERLAPPING.
         @return: Generator used to iterate over the results.
                  Or None if no keyword was found in the text.
         '''
         if not self._finalized:
             raise ValueError('KeywordTree has not been finalized.' +
                              ' No search allowed. Call finalize() first.')
-        if self._case_insensitive:
-            text = text.lower()
+        if mode == OVERLAPPING:
+            return self._search(text, values=values)
+        if mode not in MODES:
+            raise ValueError('Unknown mode {0}.'.format(mode))
+        self._check_mode(mode)
+        text, origins = self._fold_text(text)
+        if self._compact is not None:
+            results = self._compact.search_with_mode(text, mode, values)
+        else:
+            results = self._search_with_mode(text, mode, values)
+        if origins is not None:
+            results = to_original_offsets(results, origins, 0, values)
+        return results
+
+    def search_fuzzy(self, text, max_edits=1, values=False,
+                     substitutions_only=False):
+        '''
+        Search a text for occurences of the added keywords with at most
+        max_edits edits (insertions, deletions or substitutions of single
+        characters, i.e. Levenshtein distance). Every occurence is reported
+        once, at the start and end where its distance is smallest.
+        Every keyword is split into max_edits + 1 pieces, at least one of
+        them occurs unchanged. The pieces are searched with a tree built
+        on the first call for the given max_edits (and rebuilt after the
+        keywords changed), only where they are found the distances are
+        computed. Keywords not longer than max_edits are ignored and short
+        keywords (pieces of only one or two characters) make the search
+        slow.
+        Can only be called after finalized() has been called.
+        @param max_edits: Maximum distance of a match.
+                          Defaults to 1.
+        @param values: If true, 4-Tuples with the value of the keyword,
+                       startindex, endindex and distance are returned.
+                       Defaults to false.
+        @param substitutions_only: If true, only substitutions are allowed,
+                                   i.e. the Hamming distance is used.
+                                   Defaults to false.
+        @return: Generator of 3-Tuples with keyword, startindex and distance,
+                 not necessarily ordered by startindex.
+        '''
+        if not self._finalized:
+            raise ValueError('KeywordTree has not been finalized.' +
+                             ' No search allowed. Call finalize() first.')
+        if max_edits < 0:
+            raise ValueError('max_edits must not be negative.')
+        matcher = self._get_fuzzy_matcher(max_edits, substitutions_only)
+        text, origins = self._fold_text(text)
+        return self._search_fuzzy(matcher, text, origins, values)
+
+    def _search_fuzzy(self, matcher, text, origins, values):
+        is_word = self._is_word
+        for keyword, value, start, end, distance in matcher.search(text):
+            if is_word is not None and \
+                    ((start > 0 and is_word(text[start - 1])) or
+                     (end < len(text) and is_word(text[end]))):
+                continue
+            if origins is not None:
+                end = origins[end - 1] + 1 if end > start else origins[start]
+                start = origins[start]
+            if values:
+                yield (value, start, end, distance)
+            else:
+                yield (keyword, start, distance)
+
+    def _get_fuzzy_matcher(self, max_edits, substitutions_only):
+        key = (max_edits, substitutions_only)
+        matcher = self._fuzzy_matchers.get(key)
+        if matcher is None:
+            pieces = {}
+            max_length = 0
+            for keyword, value in self._keywords_with_values():
+                folded = keyword
+                if self._folding is not None:
+                    folded = self._folding.fold(keyword)
+                if len(folded) <= max_edits:
+                    continue
+                max_length = max(max_length, len(folded))
+                compared = folded
+                if self._binary and BYTES_ARE_CHARACTERS:
+                    # Compared with the byte values of the text, but also
+                    # used as key.
+                    compared = tuple(bytearray(folded))
+                for piece, offset in split_pieces(folded, max_edits):
+                    pieces.setdefault(piece, []).append(
+                        (compared, keyword, value, offset))
+            piece_tree = KeywordTree.from_keywords(pieces.items(),
+                                                   binary=self._binary)
+            matcher = FuzzyMatcher(piece_tree, max_edits, substitutions_only,
+                                   max_length)
+            if not self._frozen:
+                self._fuzzy_matchers[key] = matcher
+        return matcher
+
+    def _keywords_with_values(self):
+        # Keywords as they were added (not the factors of patterns) with
+        # their values.
+        if self._compact is not None:
+            keywords = self._compact._keywords
+            values = self._compact._values
+            pairs = ((keywords[idx], None if values is None else values[idx])
+                     for idx in range(len(keywords)))
+        else:
+            pairs = ((state.matched_keyword, state.value)
+                     for state, _ in self._states_with_depth()
+                     if state.success)
+        for keyword, value in pairs:
+            if keyword.__class__ is PatternFactor:
+                if not keyword.is_keyword:
+                    continue
+                keyword, value = keyword.keyword, keyword.value
+            yield keyword, value
+
+    def _check_mode(self, mode):
+        if mode != OVERLAPPING and self._has_patterns:
+            raise ValueError('Trees with patterns can only search with' +
+                             ' mode OVERLAPPING.')
+
+    def contains(self, text):
+        '''
+        Checks whether any keyword occurs in text. Stops at the first
+        keyword found and neither creates a generator nor result tuples.
+        Can only be called after finalized() has been called.
+        @return: True if a keyword was found, False otherwise.
+        '''
+        if not self._finalized:
+            raise ValueError('KeywordTree has not been finalized.' +
+                             ' No search allowed. Call finalize() first.')
+        if self._word_boundaries or self._has_patterns:
+            return self.search_one(text) is not None
+        text, _ = self._fold_text(text)
+        if self._compact is not None:
+            return self._compact.contains(text)
+        prefilter = self._get_prefilter()
+        if prefilter is not None:
+            return prefilter.contains(text)
+        dense_table = self._get_dense_table()
+        if dense_table is not None:
+            return dense_table.contains(text)
+        zero_state = self._zero_state
+        zero_transitions = zero_state.transitions
+        current_state = zero_state
+        if self._shortcuts:
+            for symbol in text:
+                current_state = current_state.transitions.get(
+                    symbol, zero_transitions.get(symbol, zero_state))
+                if current_state.success or current_state.output is not None:
+                    return True
+            return False
+        for symbol in text:
+            next_state = current_state.transitions.get(symbol)
+            while next_state is None and current_state is not zero_state:
+                current_state = current_state.longest_strict_suffix
+                next_state = current_state.transitions.get(symbol)
+            current_state = next_state or zero_state
+            if current_state.success or current_state.output is not None:
+                return True
+        return False
+
+    def count(self, text, per_keyword=False):
+        '''
+        Counts the occurences of the keywords in text (overlapping ones
+        included, like search_all) without creating result tuples.
+        Can only be called after finalized() has been called.
+        @param per_keyword: If true, a Counter mapping every found keyword
+                            to its number of occurences is returned instead
+                            of the total.
+                            Defaults to false.
+        @return: Total number of occurences or a Counter.
+        '''
+        if not self._finalized:
+            raise ValueError('KeywordTree has not been finalized.' +
+                             ' No search allowed. Call finalize() first.')
+        if self._word_boundaries or self._has_patterns:
+            return self._count_results(text, per_keyword)
+        text, _ = self._fold_text(text)
+        if self._compact is not None:
+            return self._compact.count(text, per_keyword)
+        prefilter = self._get_prefilter()
+        if prefilter is not None:
+            return prefilter.count(text, per_keyword)
+        dense_table = self._get_dense_table()
+        if dense_table is not None:
+            return dense_table.count(text, per_keyword)
         zero_state = self._zero_state
+        zero_transitions = zero_state.transitions
+        shortcuts = self._shortcuts
+        counts = {}
+        total = 0
         current_state = zero_state
-        for idx, symbol in enumerate(text):
+        for symbol in text:
+            if shortcuts:
+                current_state = current_state.transitions.get(
+                    symbol, zero_transitions.get(symbol, zero_state))
+            else:
+                next_state = current_state.transitions.get(symbol)
+                while next_state is None and current_state is not zero_state:
+                    current_state = current_state.longest_strict_suffix
+                    next_state = current_state.transitions.get(symbol)
+                current_state = next_state or zero_state
+            state = current_state
+            if not state.success:
+                state = state.output
+            while state is not None:
+                if per_keyword:
+                    keyword = state.matched_keyword
+                    counts[keyword] = counts.get(keyword, 0) + 1
+                else:
+                    total += 1
+                state = state.output
+        return Counter(counts) if per_keyword else total
+
+    def _count_results(self, text, per_keyword):
+        # Matches have to be checked for word boundaries or patterns have to
+        # be verified, which the searches do already.
+        if per_keyword:
+            return Counter(keyword for keyword, _ in self._search(text))
+        total = 0
+        for _ in self._search(text):
+            total += 1
+        return total
+
+    def _search_with_mode(self, text, mode, values):
+        zero_state = self._zero_state
+        zero_transitions = zero_state.transitions
+        shortcuts = self._shortcuts
+        is_word = self._is_word
+        leftmost_first = mode == LEFTMOST_FIRST
+        non_overlapping = mode == NON_OVERLAPPING
+        length = len(text)
+        idx = 0
+        current_state = zero_state
+        # Best match found so far, reported as soon as no match starting
+        # further left can be found anymore.
+        best = None
+        best_start = 0
+        best_end = 0
+        while True:
+            if idx < length:
+                symbol = text[idx]
+                idx += 1
+                if shortcuts:
+                    current_state = current_state.transitions.get(
+                        symbol, zero_transitions.get(symbol, zero_state))
+                else:
+                    next_state = current_state.transitions.get(symbol)
+                    while next_state is None and \
+                            current_state is not zero_state:
+                        current_state = current_state.longest_strict_suffix
+                        next_state = current_state.transitions.get(symbol)
+                    current_state = next_state or zero_state
+                if best is None or idx - current_state.depth <= best_start:
+                    # Only the longest keyword ending here can start further
+                    # left than best, the rest of the suffix chain is
+                    # skipped.
+                    state = current_state
+                    if not state.success:
+                        state = state.output
+                    if state is not None and is_word is not None:
+                        if idx < length and is_word(text[idx]):
+                            continue
+                        # The longest keyword starting on a word boundary
+                        while state is not None and idx > state.depth and \
+                                is_word(text[idx - state.depth - 1]):
+                            state = state.output
+                    if state is None:
+                        continue
+                    start = idx - state.depth
+                    if non_overlapping:
+                        best = state
+                        best_start = start
+                        best_end = idx
+                    elif (best is None or start < best_start or
+                          (start == best_start and
+                           (not leftmost_first or
+                            state.priority < best.priority))):
+                        best = state
+                        best_start = start
+                        best_end = idx
+                        continue
+                    else:
+                        continue
+            elif best is None:
+                break
+            if values:
+                yield (best.value, best_start, best_end)
+            else:
+                yield (best.matched_keyword, best_start)
+            # Continue right after the reported match
+            idx = best_end
+            current_state = zero_state
+            best = None
+
+    def _search(self, text, cursor=None, offset=0, values=False):
+        # cursor is a list holding the state to start from. It is updated
+        # with the state reached at the end of the text once the generator
+        # is exhausted. Reported start indices are shifted by offset. For
+        # folded trees, cursor also holds the history of the chunks
+        # searched before (see folding.chunk_history).
+        text, origins = self._fold_text(text)
+        dense_table = self._get_dense_table()
+        prefilter = self._get_prefilter() if cursor is None else None
+        if self._compact is not None:
+            results = self._compact.search_all(text, cursor, offset, values)
+        elif prefilter is not None:
+            results = prefilter.search_all(text, values, self._is_word)
+        elif dense_table is not None:
+            results = dense_table.search_all(text, cursor, offset, values,
+                                             self._is_word)
+        elif not self._shortcuts:
+            results = self._search_all_without_shortcuts(text, cursor, offset,
+                                                         values)
+        else:
+            results = self._search_all(text, cursor, offset, values)
+        if self._has_patterns:
+            results = verify_patterns(results, text, values)
+        if self._folding is not None and cursor is not None:
+            results = self._chunk_to_original_offsets(
+                results, len(text), origins, cursor, offset, values)
+        elif origins is not None:
+            results = to_original_offsets(results, origins, offset, values)
+        return results
+
+    def _chunk_to_original_offsets(self, results, length, origins, cursor,
+                                   offset, values):
+        history = cursor[1] if len(cursor) > 1 else ()
+        for result in chunk_to_original_offsets(results, origins, offset,
+                                                values, history):
+            yield result
+        # Later matches start at most as far back as the depth of the
+        # state reached.
+        cursor[1:] = [chunk_history(history, origins, offset, length,
+                                    self._state_depth(cursor[0]))]
+
+    def _state_depth(self, state):
+        if self._compact is not None:
+            return self._compact._get_depths()[state]
+        return state.depth
+
+    def _start_state(self):
+        if self._compact is not None:
+            return 0
+        return self._zero_state
+
+    def _state_identifier(self, state):
+        if self._compact is not None:
+            return state
+        self._number_states()
+        return self._identifiers[state]
+
+    def _state_by_identifier(self, identifier):
+        if self._compact is not None:
+            if not 0 <= identifier < len(self._compact):
+                raise ValueError('Unknown state {0}.'.format(identifier))
+            return identifier
+        self._number_states()
+        if not 0 <= identifier < len(self._states_by_identifier):
+            raise ValueError('Unknown state {0}.'.format(identifier))
+        return self._states_by_identifier[identifier]
+
+    def _number_states(self):
+        # Identifiers of the states for Scanners. States are numbered
+        # breadth first and the children of a state by symbol, like the
+        # states of compact automatons, so a state has the same identifier
+        # in every copy of the tree (pickled, compact or saved), no matter
+        # in which order the keywords were added.
+        if self._states_by_identifier is None:
+            states = [self._zero_state]
+            idx = 0
+            while idx < len(states):
+                state = states[idx]
+                idx += 1
+                children = [child for child in state.transitions.values()
+                            if child.parent is state]
+                children.sort(key=attrgetter('symbol'))
+                states.extend(children)
+            self._identifiers = dict(
+                (state, identifier) for identifier, state in enumerate(states))
+            self._states_by_identifier = states
+
+    def scanner(self, state=None, position=0, values=False, history=()):
+        '''
+        Returns a Scanner for searching data that arrives piece by piece.
+        Can only be called after finalized() has been called.
+        @param state: Identifier of the state to continue from, as returned
+                      by Scanner.state. Identifiers are the same for copies
+                      of the tree (pickled, compact or saved ones).
+                      Defaults to the zero state.
+        @param position: Number of characters (or bytes) already scanned,
+                         as returned by Scanner.position. Defaults to 0.
+        @param values: See search_all.
+        @param history: As returned by Scanner.history. Case insensitive
+                        and normalized trees need it to continue from a
+                        state other than the zero state, the offsets of
+                        matches starting before position depend on it.
+                        Defaults to no history.
+        '''
+        if not self._finalized:
+            raise ValueError('KeywordTree has not been finalized.' +
+                             ' No search allowed. Call finalize() first.')
+        self._check_streamable()
+        if state is not None and self._folding is not None and \
+                self._state_depth(self._state_by_identifier(state)) > \
+                len(history):
+            raise ValueError('The history of the Scanner is needed to' +
+                             ' continue from state {0}.'.format(state))
+        return Scanner(self, state, position, values, history)
+
+    def _check_streamable(self):
+        if self._word_boundaries or self._has_patterns:
+            # Whether a match at the end of a chunk ends on a word boundary
+            # (or matches a pattern) is only known once the next chunk
+            # arrives.
+            raise ValueError('Trees with word boundaries or patterns' +
+                             ' cannot search streams.')
+        if self._compact is not None and self._compact._minimized:
+            # The keyword of a match is looked up by the matched text, which
+            # can start in a previous chunk.
+            raise ValueError('Minimized trees cannot search streams.')
+
+    def _search_all(self, text, cursor=None, offset=0, values=False):
+        zero_state = self._zero_state
+        is_word = self._is_word
+        length = len(text) + offset
+        current_state = zero_state if cursor is None else cursor[0]
+        for idx, symbol in enumerate(text, offset):
             current_state = current_state.transitions.get(
                 symbol, zero_state.transitions.get(symbol, zero_state))
             state = current_state
-            while state is not zero_state:
-                if state.success:
-                    keyword = state.matched_keyword
-                    yield (keyword, idx + 1 - len(keyword))
-                state = state.longest_strict_suffix
+            if not state.success:
+                state = state.output
+            if state is not None and is_word is not None and \
+                    idx + 1 < length and is_word(text[idx + 1 - offset]):
+                # No keyword ending here ends on a word boundary
+                continue
+            while state is not None:
+                if is_word is not None and idx >= state.depth + offset and \
+                        is_word(text[idx - state.depth - offset]):
+                    state = state.output
+                    continue
+                if values:
+                    yield (state.value, idx + 1 - state.depth, idx + 1)
+                else:
+                    yield (state.matched_keyword, idx + 1 - state.depth)
+                state = state.output
+        if cursor is not None:
+            cursor[0] = current_state
 
-    def finalize(self):
+    def search_stream(self, stream, encoding=None, chunk_size=65536,
+                      values=False):
+        '''
+        Search a stream of text for all occurences of the added keywords.
+        The stream is processed chunk by chunk and the search continues
+        where the previous chunk ended, so keywords spanning chunks are
+        found and memory usage does not depend on the size of the stream.
+        Can only be called after finalized() has been called.
+        @param stream: File-like object with a read method (e.g. an opened
+                       file) or an iterable of chunks.
+        @param encoding: Needed for binary streams. If given, chunks are
+                         decoded incrementally with this encoding.
+        @param chunk_size: Number of characters (or bytes) read at once from
+                           file-like objects.
+        @param values: See search_all.
+        @return: Generator of 2-Tuples with keyword and startindex in the
+                 whole stream.
+        '''
+        if not self._finalized:
+            raise ValueError('KeywordTree has not been finalized.' +
+                             ' No search allowed. Call finalize() first.')
+        self._check_streamable()
+        return self._search_stream(stream, encoding, chunk_size, values)
+
+    def _search_stream(self, stream, encoding, chunk_size, values):
+        if hasattr(stream, 'read'):
+            # read(0) returns the empty str or bytes marking the end
+            chunks = iter(lambda: stream.read(chunk_size), stream.read(0))
+        else:
+            chunks = stream
+        if encoding is not None:
+            chunks = iterdecode(chunks, encoding)
+        cursor = [self._start_state()]
+        offset = 0
+        for chunk in chunks:
+            for result in self._search(chunk, cursor, offset, values):
+                yield result
+            offset += len(chunk)
+
+    def search_many(self, texts, values=False, mode=OVERLAPPING):
+        '''
+        Search many texts for all occurences of the added keywords in one
+        call. Faster than calling search_all for each text, especially
+        for many short texts.
+        Can only be called after finalized() has been called.
+        @param texts: Iterable of texts, e.g. a list or a generator.
+        @param values: If true, 4-Tuples with the index of the text, the
+                       value of the keyword, startindex and endindex are
+                       returned (see search_all).
+        @param mode: See search_all.
+        @return: Generator of 3-Tuples with the index of the text in texts,
+                 the keyword and the startindex in the text.
+        '''
+        return self._search_many(texts, False, values, mode)
+
+    def search_one_many(self, texts, values=False, mode=OVERLAPPING):
+        '''
+        Like search_many, but only the first keyword found in every text is
+        returned (see search_one). Texts without any keyword are skipped.
+        @return: Generator of 3-Tuples with the index of the text in texts,
+                 the keyword and the startindex in the text.
+        '''
+        return self._search_many(texts, True, values, mode)
+
+    def _search_many(self, texts, first_only, values, mode):
+        if not self._finalized:
+            raise ValueError('KeywordTree has not been finalized.' +
+                             ' No search allowed. Call finalize() first.')
+        if mode != OVERLAPPING:
+            if mode not in MODES:
+                raise ValueError('Unknown mode {0}.'.format(mode))
+            self._check_mode(mode)
+            return self._search_many_generic(texts, first_only, values, mode)
+        if self._has_patterns or self._dense or self._prefilter or \
+                (self._compact is None and not self._shortcuts):
+            return self._search_many_generic(texts, first_only, values, mode)
+        if self._folding is not None:
+            origins_by_doc = {}
+            texts = self._folding.fold_texts(texts, origins_by_doc)
+        if self._binary and BYTES_ARE_CHARACTERS:
+            texts = map(byte_values, texts)
+        if self._compact is not None:
+            results = self._compact.search_many(texts, first_only, values)
+        else:
+            results = self._search_many_with_shortcuts(texts, first_only,
+                                                       values)
+        if self._folding is not None:
+            results = many_to_original_offsets(results, origins_by_doc,
+                                               values)
+        return results
+
+    def _search_many_generic(self, texts, first_only, values, mode):
+        for doc_index, text in enumerate(texts):
+            for result in self.search_all(text, values, mode):
+                yield (doc_index,) + result
+                if first_only:
+                    break
+
+    def _search_many_with_shortcuts(self, texts, first_only, values):
+        zero_state = self._zero_state
+        zero_transitions = zero_state.transitions
+        is_word = self._is_word
+        for doc_index, text in enumerate(texts):
+            length = len(text)
+            current_state = zero_state
+            for idx, symbol in enumerate(text):
+                current_state = current_state.transitions.get(
+                    symbol, zero_transitions.get(symbol, zero_state))
+                state = current_state
+                if not state.success:
+                    state = state.output
+                if state is not None and is_word is not None and \
+                        idx + 1 < length and is_word(text[idx + 1]):
+                    continue
+                while state is not None:
+                    if is_word is not None and idx >= state.depth and \
+                            is_word(text[idx - state.depth]):
+                        state = state.output
+                        continue
+                    if values:
+                        yield (doc_index, state.value,
+                               idx + 1 - state.depth, idx + 1)
+                    else:
+                        yield (doc_index, state.matched_keyword,
+                               idx + 1 - state.depth)
+                    if first_only:
+                        break
+                    state = state.output
+                else:
+                    continue
+                # Only reached if the first keyword of the text was found
+                break
+
+    def _search_all_without_shortcuts(self, text, cursor=None, offset=0,
+                                      values=False):
+        zero_state = self._zero_state
+        is_word = self._is_word
+        length = len(text) + offset
+        current_state = zero_state if cursor is None else cursor[0]
+        for idx, symbol in enumerate(text, offset):
+            next_state = current_state.transitions.get(symbol)
+            if next_state is None:
+                state = current_state
+                while next_state is None and state is not zero_state:
+                    state = state.longest_strict_suffix
+                    next_state = state.transitions.get(symbol)
+                if next_state is None:
+                    next_state = zero_state
+            current_state = next_state
+            state = current_state
+            if not state.success:
+                state = state.output
+            if state is not None and is_word is not None and \
+                    idx + 1 < length and is_word(text[idx + 1 - offset]):
+                continue
+            while state is not None:
+                if is_word is not None and idx >= state.depth + offset and \
+                        is_word(text[idx - state.depth - offset]):
+                    state = state.output
+                    continue
+                if values:
+                    yield (state.value, idx + 1 - state.depth, idx + 1)
+                else:
+                    yield (state.matched_keyword, idx + 1 - state.depth)
+                state = state.output
+        if cursor is not None:
+            cursor[0] = current_state
+
+    def finalize(self, compact=False, minimize=False, dense=False,
+                 prefilter=False):
         '''
         Needs to be called after all keywords have been added and
         before any searching is performed.
+        @param compact: If true, the tree is frozen into a CompactAutomaton.
+                        All states and transitions are then stored in flat
+                        arrays instead of State objects and dicts, which
+                        needs a lot less memory at the cost of a slower
+                        search.
+                        Defaults to false.
+        @param minimize: If true, the tree is frozen into a CompactAutomaton
+                         (like with compact) and all equivalent states are
+                         merged (see CompactAutomaton.minimized()).
+                         Keywords sharing their endings then share the
+                         states of them, too. Minimized trees cannot search
+                         streams and don't support patterns.
+                         Defaults to false.
+        @param dense: If true, the transitions are also stored in a dense
+                      table (see DenseTable) with one row per state and one
+                      column per character of the keywords. Searching
+                      doesn't hash the characters of the text then, which
+                      makes search_all, contains and count faster, but
+                      the table needs memory for every combination of
+                      state and character. Only for trees with shortcuts
+                      that are not compact. The table is rebuilt on the
+                      first search after keywords have been added or
+                      removed.
+                      Defaults to false.
+        @param prefilter: If true, search_all, contains and count first
+                          look for the first characters of the keywords
+                          with a regular expression (see Prefilter) and
+                          only follow the trie from there. Much faster for
+                          texts in which these characters are rare (e.g.
+                          keywords starting with uppercase letters or
+                          digits), slower if they are frequent. Not used
+                          for streams and the other search modes. Only for
+                          trees that are not compact.
+                          Defaults to false.
+        @return: Number of states saved by minimize.
         '''
+        self._check_not_frozen()
         if self._finalized:
             raise ValueError('KeywordTree has already been finalized.')
+        if dense and (compact or minimize or not self._shortcuts):
+            raise ValueError('Only trees with shortcuts that are not' +
+                             ' compact can be dense.')
+        if prefilter and (compact or minimize):
+            raise ValueError('Compact trees cannot use a prefilter.')
+        if minimize and self._has_patterns:
+            raise ValueError('Trees with patterns cannot be minimized.')
+        if compact or minimize:
+            self._compact = CompactAutomaton.from_zero_state(
+                self._zero_state, self._case_insensitive, self._binary,
+                self._normalize, self._word_boundaries,
+                self._word_characters)
+            self._zero_state = None
+            self._finalized = True
+            if not minimize:
+                return 0
+            state_count = len(self._compact)
+            self._compact = self._compact.minimized()
+            return state_count - len(self._compact)
         self._zero_state.longest_strict_suffix = self._zero_state
         self.search_lss_for_children(self._zero_state)
         self._finalized = True
+        self._dense = dense
+        self._prefilter = prefilter
+        return 0
+
+    def _get_dense_table(self):
+        # None if the tree isn't dense
+        if self._dense and self._dense_table is None:
+            self._dense_table = DenseTable(self._zero_state, self._counter,
+                                           self._binary)
+        return self._dense_table
+
+    def freeze(self):
+        '''
+        Makes a finalized tree immutable, so that it can be shared by any
+        number of threads: everything that is otherwise built on first use
+        (dense table, prefilter, ...) is built now, the caches of characters
+        of normalized and dense trees stop growing and add, add_pattern,
+        remove and finalize raise a ValueError from now on. Searching a
+        frozen tree doesn't change it anymore, only the generators and
+        Scanners returned by it have state, which belongs to the thread
+        using them.
+        search_fuzzy keeps using the matchers built by calls before
+        freezing. Matchers for other parameters are built again for every
+        call and not kept.
+        Copies of the tree (pickled or saved and opened) are not frozen.
+        Freezing a frozen tree does nothing.
+        @return: The tree itself.
+        '''
+        if not self._finalized:
+            raise ValueError('KeywordTree has not been finalized.' +
+                             ' Call finalize() first.')
+        if self._frozen:
+            return self
+        if self._folding is not None:
+            self._folding.freeze()
+        if self._compact is not None:
+            self._compact.prepare()
+        else:
+            dense_table = self._get_dense_table()
+            if dense_table is not None:
+                dense_table.freeze()
+            self._get_prefilter()
+            self._state_by_identifier(0)
+        for matcher in self._fuzzy_matchers.values():
+            matcher.freeze()
+        self._frozen = True
+        return self
+
+    def _check_not_frozen(self):
+        if self._frozen:
+            raise ValueError('KeywordTree is frozen.' +
+                             ' No more changes allowed.')
+
+    def _get_prefilter(self):
+        # None if the tree doesn't use a prefilter
+        if self._prefilter and self._prefilter_searcher is None:
+            self._prefilter_searcher = Prefilter(self._zero_state,
+                                                 self._binary)
+        return self._prefilter_searcher
 
     def search_lss_for_children(self, zero_state):
+        '''
+        Computes the longest strict suffixes (and the output links and
+        shortcut transitions) of all states level by level. When a level
+        is processed, the suffixes and transitions of all shorter states
+        are complete already, so every suffix is computed exactly once.
+        '''
+        shortcuts = self._shortcuts
+        zero_transitions = zero_state.transitions
+        level = list(zero_transitions.values())
+        for state in level:
+            state.longest_strict_suffix = zero_state
+        while level:
+            next_level = []
+            for state in level:
+                state_suffix = state.longest_strict_suffix
+                # The transitions of state are still only the ones of the
+                # trie, the shortcuts are merged in below.
+                for symbol, child in state.transitions.items():
+                    if shortcuts:
+                        suffix = state_suffix.transitions.get(symbol)
+                        if suffix is None:
+                            suffix = zero_transitions.get(symbol, zero_state)
+                    else:
+                        traversed = state_suffix
+                        while True:
+                            suffix = traversed.transitions.get(symbol)
+                            if suffix is not None:
+                                break
+                            if traversed is zero_state:
+                                suffix = zero_state
+                                break
+                            traversed = traversed.longest_strict_suffix
+                    child.longest_strict_suffix = suffix
+                    # suffix is shorter than child, so its output is
+                    # complete already
+                    child.output = suffix if suffix.success else suffix.output
+                    next_level.append(child)
+                if shortcuts and state_suffix is not zero_state:
+                    transitions = dict(state_suffix.transitions)
+                    transitions.update(state.transitions)
+                    state.transitions = transitions
+            level = next_level
+
+    def _max_keyword_length(self):
+        if self._compact is not None:
+            return self._compact.max_keyword_length()
+        return max(depth for _, depth in self._states_with_depth())
+
+    def _add_to_finalized(self, keyword, original_keyword, value,
+                          pattern=None):
+        # Follow the transitions of the trie (no shortcuts) as far as
+        # possible.
+        zero_state = self._zero_state
+        prefix_state = zero_state
+        prefix_length = 0
+        for char in keyword:
+            next_state = prefix_state.transitions.get(char)
+            if next_state is None or next_state.parent is not prefix_state:
+                break
+            prefix_state = next_state
+            prefix_length += 1
+        if prefix_length == len(keyword):
+            was_keyword = prefix_state.success
+            self._set_keyword(prefix_state, original_keyword, value,
+                              pattern)
+            if not was_keyword:
+                self._update_outputs([prefix_state],
+                                     self._get_suffix_children())
+            return
+        suffix_children = self._get_suffix_children()
+        parents_by_symbol = self._get_parents_by_symbol()
+        self._states_by_identifier = None
+        self._identifiers = None
+
+        # States whose string ends with the string of the first new state
+        # (i.e. whose suffix chain contains prefix_state followed by the
+        # first new symbol), with their depth. Every state ends with the
+        # empty string of the zero state, so only the states with a
+        # transition for that symbol have to be looked at.
+        first_symbol = keyword[prefix_length]
+        if prefix_state is zero_state:
+            candidates = parents_by_symbol.get(first_symbol, ())
+        else:
+            candidates = self._suffix_descendants(prefix_state,
+                                                  suffix_children)
+        level = []
+        for state in candidates:
+            next_state = state.transitions.get(first_symbol)
+            if next_state is not None and next_state.parent is state:
+                level.append((next_state, next_state.depth))
+
+        new_states = []
+        state = prefix_state
+        for char in keyword[prefix_length:]:
+            next_state = State(self._counter, parent=state, symbol=char)
+            self._counter += 1
+            # Replaces a shortcut transition, if there is one
+            state.transitions[char] = next_state
+            parents_by_symbol.setdefault(char, set()).add(state)
+            new_states.append((next_state, next_state.depth))
+            state = next_state
+        self._set_keyword(state, original_keyword, value, pattern)
+
+        first_state = new_states[0][0]
+        if self._shortcuts and prefix_state is not zero_state:
+            # States whose suffix chain reaches prefix_state before any
+            # state with a transition for first_symbol now shortcut to
+            # first_state. Transitions of the zero state are not copied
+            # into other states, so nothing to do if it's the prefix.
+            to_process = list(suffix_children.get(prefix_state, ()))
+            while to_process:
+                state = to_process.pop()
+                next_state = state.transitions.get(first_symbol)
+                if next_state is not None and next_state.parent is state:
+                    continue
+                state.transitions[first_symbol] = first_state
+                to_process.extend(suffix_children.get(state, ()))
+
+        # Existing states whose string ends with the string of one of the
+        # new states need new suffix links (and shortcut transitions).
+        # Their parents end with the string of the previous new state.
+        affected = list(level)
+        for char in keyword[prefix_length + 1:]:
+            next_level = []
+            for state, depth in level:
+                next_state = state.transitions.get(char)
+                if next_state is not None and next_state.parent is state:
+                    next_level.append((next_state, depth + 1))
+            affected.extend(next_level)
+            level = next_level
+        affected.extend(new_states)
+        # Shorter states first, their suffix links and transitions are
+        # used for the longer ones.
+        affected.sort(key=lambda state_with_depth: state_with_depth[1])
         processed = set()
-        to_process = [zero_state]
+        for state, _ in affected:
+            if state in processed:
+                continue
+            processed.add(state)
+            old_suffix = state.longest_strict_suffix
+            suffix = self._find_lss(state)
+            if old_suffix is not suffix:
+                if old_suffix is not None:
+                    suffix_children[old_suffix].discard(state)
+                suffix_children.setdefault(suffix, set()).add(state)
+                state.longest_strict_suffix = suffix
+            if self._shortcuts:
+                if suffix is zero_state:
+                    transitions = {}
+                else:
+                    transitions = dict(suffix.transitions)
+                for symbol, next_state in state.transitions.items():
+                    if next_state.parent is state:
+                        transitions[symbol] = next_state
+                state.transitions = transitions
+        self._update_outputs(processed, suffix_children)
+
+    def _update_outputs(self, states, suffix_children):
+        # Repairs the output links after the suffix links or the success
+        # flags of states have changed. The output links of states and of
+        # all states whose suffix chain contains one of them are recomputed,
+        # as long as they change.
+        to_process = []
+        for state in states:
+            to_process.append(state)
+            to_process.extend(suffix_children.get(state, ()))
         while to_process:
             state = to_process.pop()
-            processed.add(state.identifier)
-            for child in state.transitions.values():
-                if child.identifier not in processed:
-                    self.search_lss(child)
-                    to_process.append(child)
+            suffix = state.longest_strict_suffix
+            output = suffix if suffix.success else suffix.output
+            if output is not state.output:
+                state.output = output
+                if not state.success:
+                    to_process.extend(suffix_children.get(state, ()))
 
-    def search_lss(self, state):
+    def _find_lss(self, state):
+        # Classic construction of the longest strict suffix using only the
+        # transitions of the trie. The suffixes of all shorter states have
+        # to be up to date.
         zero_state = self._zero_state
-        parent = state.parent
-        traversed = parent.longest_strict_suffix
+        if state.parent is zero_state:
+            return zero_state
+        symbol = state.symbol
+        traversed = state.parent.longest_strict_suffix
         while True:
-            if state.symbol in traversed.transitions and\
-                    traversed.transitions[state.symbol] is not state:
-                state.longest_strict_suffix =\
-                    traversed.transitions[state.symbol]
-                break
-            elif traversed is zero_state:
-                state.longest_strict_suffix = zero_state
-                break
-            else:
-                traversed = traversed.longest_strict_suffix
-        suffix = state.longest_strict_suffix
-        if suffix is zero_state:
-            return
-        if suffix.longest_strict_suffix is None:
-            self.search_lss(suffix)
-        for symbol, next_state in suffix.transitions.items():
-            if symbol not in state.transitions:
-                state.transitions[symbol] = next_state
+            next_state = traversed.transitions.get(symbol)
+            if next_state is not None and next_state.parent is traversed:
+                return next_state
+            if traversed is zero_state:
+                return zero_state
+            traversed = traversed.longest_strict_suffix
+
+    def _get_suffix_children(self):
+        # Maps each state to the set of states that have it as longest
+        # strict suffix. Only needed for additions after finalize(), so it
+        # is built on first use.
+        if self._suffix_children is None:
+            suffix_children = {}
+            zero_state = self._zero_state
+            for state, _ in self._states_with_depth():
+                if state is not zero_state:
+                    suffix_children.setdefault(
+                        state.longest_strict_suffix, set()).add(state)
+            self._suffix_children = suffix_children
+        return self._suffix_children
+
+    def _get_parents_by_symbol(self):
+        # Maps each symbol to the set of states with a transition of the
+        # trie for it. Like _get_suffix_children only built on first use.
+        if self._parents_by_symbol is None:
+            parents_by_symbol = {}
+            for state, _ in self._states_with_depth():
+                for symbol, child in state.transitions.items():
+                    if child.parent is state:
+                        parents_by_symbol.setdefault(symbol, set()).add(
+                            state)
+            self._parents_by_symbol = parents_by_symbol
+        return self._parents_by_symbol
+
+    def _states_with_depth(self):
+        result = []
+        to_process = [(self._zero_state, 0)]
+        while to_process:
+            state, depth = to_process.pop()
+            result.append((state, depth))
+            for child in state.transitions.values():
+                if child.parent is state:
+                    to_process.append((child, depth + 1))
+        return result
+
+    def _suffix_descendants(self, state, suffix_children):
+        result = []
+        to_process = [state]
+        while to_process:
+            state = to_process.pop()
+            result.append(state)
+            to_process.extend(suffix_children.get(state, ()))
+        return result
+
+    def save(self, path):
+        '''
+        Writes the tree to path in a binary format that can be memory
+        mapped by KeywordTree.open(). Can be called before and after
+        finalize(). Trees with patterns can't be saved.
+        '''
+        if self._has_patterns:
+            raise ValueError('Trees with patterns cannot be saved.')
+        if self._compact is not None:
+            compact = self._compact
+        else:
+            compact = CompactAutomaton.from_zero_state(
+                self._zero_state, self._case_insensitive, self._binary,
+                self._normalize, self._word_boundaries,
+                self._word_characters)
+        compact.save(path)
+
+    @classmethod
+    def open(cls, path, word_characters=None):
+        '''
+        Opens a tree written by save(). The file is memory mapped and
+        searched directly without deserializing it, so opening is almost
+        instant and all processes opening the same file share one copy of
+        the automaton through the page cache. The returned tree is
+        finalized and compact (see finalize()).
+        @param word_characters: Custom word characters of a tree with word
+                                boundaries (see the constructor). They are
+                                not stored in the file.
+        '''
+        compact = CompactAutomaton.open(path)
+        kwtree = cls(case_insensitive=compact._case_insensitive,
+                     binary=compact._binary, normalize=compact._normalize,
+                     word_boundaries=compact._word_boundaries,
+                     word_characters=word_characters)
+        compact._word_characters = kwtree._word_characters
+        kwtree._zero_state = None
+        kwtree._compact = compact
+        kwtree._finalized = True
+        return kwtree
 
     def __str__(self):
         return "ahocorapy KeywordTree"
 
     def __getstate__(self):
-        state_list = [None] * self._counter
-        todo_list = [self._zero_state]
-        while todo_list:
-            state = todo_list.pop()
-            transitions = {key: value.identifier for key,
-                           value in state.transitions.items()}
-            state_list[state.identifier] = {
-                'symbol': state.symbol,
-                'success': state.success,
-                'parent':  state.parent.identifier if state.parent is not None else None,
-                'matched_keyword': state.matched_keyword,
-                'longest_strict_suffix': state.longest_strict_suffix.identifier if state.longest_strict_suffix is not None else None,
-                'transitions': transitions
+        if self._compact is not None:
+            return {
+                'case_insensitive': self._case_insensitive,
+                'binary': self._binary,
+                'normalize': self._normalize,
+                'word_boundaries': self._word_boundaries,
+                'word_characters': self._word_characters,
+                'has_patterns': self._has_patterns,
+                'finalized': self._finalized,
+                'counter': self._counter,
+                'compact': self._compact
             }
+        # States are renumbered breadth first, so that on deserialization
+        # every state comes after its parent and its longest strict suffix.
+        # Only the trie itself is stored, shortcut transitions are derived
+        # again from the suffixes.
+        binary = self._binary
+        new_identifiers = [0] * self._counter
+        parents = array('i', [-1])
+        symbols = array('i', [-1])
+        suffixes = array('i', [0]) if self._finalized else None
+        keyword_states = []
+        order = [self._zero_state]
+        idx = 0
+        while idx < len(order):
+            state = order[idx]
+            if state.success:
+                keyword_states.append((state.priority, idx))
             for child in state.transitions.values():
-                if len(state_list) <= child.identifier or not state_list[child.identifier]:
-                    todo_list.append(child)
-
+                if child.parent is state:
+                    new_identifiers[child.identifier] = len(order)
+                    order.append(child)
+                    parents.append(idx)
+                    symbols.append(
+                        child.symbol if binary else ord(child.symbol))
+            idx += 1
+        if suffixes is not None:
+            for state in order[1:]:
+                suffixes.append(
+                    new_identifiers[state.longest_strict_suffix.identifier])
+        # Keywords are stored in the order they were added, which restores
+        # their priorities.
+        keyword_states.sort()
+        keywords = [order[idx].matched_keyword for _, idx in keyword_states]
+        values = [order[idx].value for _, idx in keyword_states]
+        keyword_states = array('i', [idx for _, idx in keyword_states])
         return {
+            'version': 2,
             'case_insensitive': self._case_insensitive,
+            'shortcuts': self._shortcuts,
+            'binary': self._binary,
+            'encoding': self._encoding,
+            'normalize': self._normalize,
+            'word_boundaries': self._word_boundaries,
+            'word_characters': self._word_characters,
+            'has_patterns': self._has_patterns,
             'finalized': self._finalized,
-            'counter': self._counter,
-            'states': state_list
+            'dense': self._dense,
+            'prefilter': self._prefilter,
+            'parents': parents,
+            'symbols': symbols,
+            'suffixes': suffixes,
+            'keyword_states': keyword_states,
+            'keywords': keywords,
+            'values': values if any(value is not None for value in values)
+            else None
         }
 
     def __setstate__(self, state):
         self._case_insensitive = state['case_insensitive']
-        self._counter = state['counter']
+        self._shortcuts = state.get('shortcuts', True)
+        self._binary = state.get('binary', False)
+        self._encoding = state.get('encoding', 'utf-8')
+        self._normalize = state.get('normalize', False)
+        self._folding = self._create_folding()
+        self._word_boundaries = state.get('word_boundaries', False)
+        self._word_characters = state.get('word_characters')
+        self._is_word = self._create_word_test()
+        self._has_patterns = state.get('has_patterns', False)
+        self._fuzzy_matchers = {}
+        self._dense = state.get('dense', False)
+        self._dense_table = None
+        self._prefilter = state.get('prefilter', False)
+        self._prefilter_searcher = None
+        self._frozen = False
+        self._states_by_identifier = None
+        self._identifiers = None
+        self._suffix_children = None
+        self._parents_by_symbol = None
         self._finalized = state['finalized']
+        self._compact = state.get('compact')
+        if self._compact is not None:
+            self._counter = state['counter']
+            self._keyword_counter = 0
+            self._zero_state = None
+        elif 'states' in state:
+            self._counter = state['counter']
+            self._setstate_version_1(state)
+        else:
+            self._setstate_version_2(state)
+
+    def _setstate_version_2(self, state):
+        parents = state['parents']
+        symbols = state['symbols']
+        binary = self._binary
+        zero_state = State(0)
+        states = [zero_state]
+        for idx in range(1, len(parents)):
+            parent = states[parents[idx]]
+            symbol = symbols[idx] if binary else chr(symbols[idx])
+            next_state = State(idx, symbol, parent)
+            parent.transitions[symbol] = next_state
+            states.append(next_state)
+        for priority, (idx, keyword) in enumerate(
+                zip(state['keyword_states'], state['keywords'])):
+            states[idx].success = True
+            states[idx].matched_keyword = keyword
+            states[idx].priority = priority
+        self._keyword_counter = len(state['keywords'])
+        values = state.get('values')
+        if values is not None:
+            for idx, value in zip(state['keyword_states'], values):
+                states[idx].value = value
+        suffixes = state['suffixes']
+        if suffixes is not None:
+            zero_state.longest_strict_suffix = zero_state
+            for idx in range(1, len(states)):
+                current_state = states[idx]
+                suffix = states[suffixes[idx]]
+                current_state.longest_strict_suffix = suffix
+                current_state.output = suffix if suffix.success \
+                    else suffix.output
+                if self._shortcuts and suffix is not zero_state:
+                    transitions = dict(suffix.transitions)
+                    transitions.update(current_state.transitions)
+                    current_state.transitions = transitions
+        self._counter = len(states)
+        self._zero_state = zero_state
+
+    def _setstate_version_1(self, state):
         states = [None] * len(state['states'])
         for idx, serialized_state in enumerate(state['states']):
             deserialized_state = State(idx, serialized_state['symbol'])
@@ -222,4 +1630,91 @@ class KeywordTree(object):
                 deserialized_state.parent = None
             deserialized_state.transitions = {
                 key: states[value] for key, value in serialized_state['transitions'].items()}
+        self._keyword_counter = 0
+        for deserialized_state in states:
+            if deserialized_state.success:
+                deserialized_state.priority = self._keyword_counter
+                self._keyword_counter += 1
+        # Breadth first, so that suffixes are processed before the states
+        # ending with them.
+        order = [states[0]]
+        idx = 0
+        while idx < len(order):
+            deserialized_state = order[idx]
+            idx += 1
+            for child in deserialized_state.transitions.values():
+                if child.parent is deserialized_state:
+                    child.depth = deserialized_state.depth + 1
+                    suffix = child.longest_strict_suffix
+                    if suffix is not None:
+                        child.output = suffix if suffix.success \
+                            else suffix.output
+                    order.append(child)
         self._zero_state = states[0]
+
+
+class Scanner(object):
+    '''
+    Resumable search over data arriving in chunks, e.g. from a socket.
+    Obtained from KeywordTree.scanner(). The search continues where the
+    previous chunk ended, so keywords spanning chunks are found. state,
+    position and history can be stored to continue the search later with
+    a new Scanner of the same tree or a copy of it.
+    A Scanner must not be fed from multiple threads at the same time.
+    '''
+
+    def __init__(self, kwtree, state=None, position=0, values=False,
+                 history=()):
+        self._kwtree = kwtree
+        self._values = values
+        if state is None:
+            self._cursor = [kwtree._start_state()]
+        else:
+            self._cursor = [kwtree._state_by_identifier(state)]
+        if kwtree._folding is not None and len(history) > 0:
+            self._cursor.append(array(OFFSET_TYPECODE, history))
+        self._position = position
+
+    @property
+    def state(self):
+        '''
+        Identifier of the current state of the automaton.
+        '''
+        return self._kwtree._state_identifier(self._cursor[0])
+
+    @property
+    def history(self):
+        '''
+        Tuple of the offsets of the last characters fed, as far as later
+        matches can start before position. Only case insensitive and
+        normalized trees keep them, for others it is empty.
+        '''
+        if len(self._cursor) > 1:
+            return tuple(self._cursor[1])
+        return ()
+
+    @property
+    def position(self):
+        '''
+        Number of characters (or bytes) fed so far.
+        '''
+        return self._position
+
+    def feed(self, chunk):
+        '''
+        Searches the next chunk of data.
+        @return: List of 2-Tuples with keyword and startindex relative to
+                 the beginning of all data fed (or 3-Tuples with value,
+                 startindex and endindex, see KeywordTree.search_all).
+        '''
+        results = list(self._kwtree._search(chunk, self._cursor,
+                                            self._position, self._values))
+        self._position += len(chunk)
+        return results
+
+    def reset(self):
+        '''
+        Starts over as if no data had been fed.
+        '''
+        self._cursor = [self._kwtree._start_state()]
+        self._position = 0
@@ -0,0 +1,219 @@
+'''
+Searching with multiple processes or threads.
+
+The search itself is pure python and therefore bound to one core by the GIL.
+ParallelSearcher distributes batches of texts or chunks of one big text over
+a pool of worker processes. Every worker receives the finalized KeywordTree
+once when it is started (or memory maps it, if the tree was opened from a
+file), so the tree is not pickled again for every task.
+ThreadSearcher does the same with a pool of threads sharing one frozen
+KeywordTree, which only uses more than one core on free-threaded builds of
+CPython.
+'''
+
+from builtins import object, range
+from functools import partial
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+from ahocorapy.keywordtree import KeywordTree
+
+
+_worker_tree = None
+
+
+def _init_worker(kwtree, path, word_characters=None):
+    global _worker_tree
+    if path is not None:
+        _worker_tree = KeywordTree.open(path, word_characters)
+    else:
+        _worker_tree = kwtree
+
+
+def _worker_arguments(kwtree):
+    # Arguments of _init_worker, trees opened from a file are opened again
+    # by every worker instead of being pickled.
+    if kwtree._compact is not None and kwtree._compact._path is not None:
+        return (None, kwtree._compact._path, kwtree._word_characters)
+    return (kwtree, None)
+
+
+def _batch_results(kwtree, task):
+    first_index, texts = task
+    return [(first_index + doc_index, keyword, start)
+            for doc_index, keyword, start in kwtree.search_many(texts)]
+
+
+def _search_batch(task):
+    return _batch_results(_worker_tree, task)
+
+
+def _search_text(text):
+    return list(_worker_tree.search_all(text))
+
+
+def _chunk_results(kwtree, task):
+    # chunk_start is the position of the chunk in the whole text, the
+    # chunk itself begins with the overlap taken from the previous chunk.
+    # Matches ending in the overlap have been found by the previous chunk
+    # already. The last lookahead characters belong to the next chunk,
+    # they are only needed to check the word boundaries.
+    chunk, chunk_start, overlap, lookahead = task
+    end = len(chunk) - lookahead
+    results = []
+    for keyword, start in kwtree.search_all(chunk):
+        if overlap < _match_end(kwtree, chunk, keyword, start) <= end:
+            results.append((keyword, chunk_start - overlap + start))
+    return results
+
+
+def _match_end(kwtree, text, keyword, start):
+    # Lowercasing can expand characters of case insensitive trees, so the
+    # match can be longer than the keyword. It ends with the character
+    # whose folded form completes the folded keyword.
+    folding = kwtree._folding
+    if folding is None or kwtree._binary:
+        return start + len(keyword)
+    remaining = len(folding.fold(keyword))
+    end = start
+    while remaining > 0:
+        remaining -= len(folding.fold(text[end]))
+        end += 1
+    return end
+
+
+def _search_chunk(task):
+    return _chunk_results(_worker_tree, task)
+
+
+class ParallelSearcher(object):
+    '''
+    Searches with a pool of worker processes sharing one finalized
+    KeywordTree. Results are identical to the ones of the tree's own search
+    methods and are returned in the same order.
+    '''
+
+    def __init__(self, kwtree, processes=None, batch_size=1000,
+                 chunk_size=1000000):
+        '''
+        @param kwtree: A finalized KeywordTree.
+        @param processes: Number of worker processes. Defaults to the number
+                          of cpus.
+        @param batch_size: Number of texts sent to a worker at once by
+                           search_many.
+        @param chunk_size: Number of characters of one text sent to a worker
+                           at once by search_all.
+        '''
+        if not kwtree._finalized:
+            raise ValueError('KeywordTree has not been finalized.' +
+                             ' No search allowed. Call finalize() first.')
+        self._batch_size = batch_size
+        self._chunk_size = chunk_size
+        self._has_patterns = kwtree._has_patterns
+        self._normalize = kwtree._normalize
+        # Lowercasing never shortens the text, so a match is at most as
+        # long as its folded keyword and the overlap covers it. Normalized
+        # trees drop combining marks, their matches can be any longer.
+        self._overlap = 0
+        if not self._has_patterns:
+            self._overlap = max(kwtree._max_keyword_length() - 1, 0)
+        # Matches on word boundaries depend on one character before and
+        # after them.
+        self._lookahead = 1 if kwtree._word_boundaries else 0
+        self._overlap += self._lookahead
+        self._start(kwtree, processes)
+
+    def _start(self, kwtree, processes):
+        self._pool = Pool(processes, _init_worker, _worker_arguments(kwtree))
+        self._search_batch = _search_batch
+        self._search_chunk = _search_chunk
+
+    def search_many(self, texts):
+        '''
+        Same as KeywordTree.search_many, texts are searched by the workers
+        in batches of batch_size.
+        '''
+        return self._search_many(texts)
+
+    def _search_many(self, texts):
+        for results in self._pool.imap(self._search_batch,
+                                       self._batches(texts)):
+            for result in results:
+                yield result
+
+    def _batches(self, texts):
+        batch = []
+        first_index = 0
+        for text in texts:
+            batch.append(text)
+            if len(batch) >= self._batch_size:
+                yield (first_index, batch)
+                first_index += len(batch)
+                batch = []
+        if batch:
+            yield (first_index, batch)
+
+    def search_all(self, text):
+        '''
+        Same as KeywordTree.search_all. The text is split into chunks of
+        chunk_size characters which are searched by the workers. Every chunk
+        additionally contains the end of the previous one, so that keywords
+        crossing chunk boundaries are found, too. Not supported for trees
+        with patterns and normalized trees, whose matches can span any
+        number of combining marks.
+        '''
+        if self._has_patterns or self._normalize:
+            raise ValueError('Texts cannot be split into chunks for trees' +
+                             ' with patterns and normalized trees.')
+        return self._search_all(text)
+
+    def _search_all(self, text):
+        for results in self._pool.imap(self._search_chunk, self._chunks(text)):
+            for result in results:
+                yield result
+
+    def _chunks(self, text):
+        for chunk_start in range(0, len(text), self._chunk_size):
+            overlap = min(self._overlap, chunk_start)
+            chunk_end = chunk_start + self._chunk_size
+            lookahead = self._lookahead if chunk_end < len(text) else 0
+            chunk = text[chunk_start - overlap:chunk_end + lookahead]
+            yield (chunk, chunk_start, overlap, lookahead)
+
+    def close(self):
+        '''
+        Stops the worker processes.
+        '''
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ThreadSearcher(ParallelSearcher):
+    '''
+    Same as ParallelSearcher, but with a pool of threads sharing the tree
+    instead of worker processes. The tree is frozen (see
+    KeywordTree.freeze()), so it cannot be changed anymore. With the GIL
+    only one thread searches at a time, on free-threaded builds of CPython
+    the threads search on all cores without copying the tree.
+    '''
+
+    def __init__(self, kwtree, threads=None, batch_size=1000,
+                 chunk_size=1000000):
+        '''
+        @param threads: Number of threads. Defaults to the number of cpus.
+        See ParallelSearcher for the other parameters.
+        '''
+        super(ThreadSearcher, self).__init__(kwtree, threads, batch_size,
+                                             chunk_size)
+
+    def _start(self, kwtree, threads):
+        kwtree.freeze()
+        self._pool = ThreadPool(threads)
+        self._search_batch = partial(_batch_results, kwtree)
+        self._search_chunk = partial(_chunk_results, kwtree)
@@ -0,0 +1,298 @@
+'''
+Keyword patterns for KeywordTree.add_pattern.
+
+Syntax:
+    ?       any single character
+    [abc]   one of the characters, ranges like [a-z] are allowed
+    [^abc]  any single character except the given ones
+    {x}     optional character (or class or ?)
+    \\x      the character x itself, e.g. \\? or \\[
+
+A pattern is not enumerated into all the keywords it matches. Only its
+longest run of required characters and small classes, the factor, is
+added to the trie (once for each combination of the classes). When the
+factor is found, the parts of the pattern before and after it are verified
+with anchored regular expressions.
+'''
+
+from builtins import chr, object, range
+from itertools import product
+import re
+
+
+# Maximum number of factors a pattern is expanded into
+MAX_FACTORS = 64
+
+
+def _fold_class_character(char, fold):
+    folded = fold(char)
+    if len(folded) != 1:
+        raise ValueError(
+            'Character {0} cannot be used in a class.'.format(char))
+    return folded
+
+
+def _parse_class(pattern, position, fold):
+    # position is right after '[', returns the class and the position right
+    # after ']'
+    negated = pattern.startswith('^', position)
+    if negated:
+        position += 1
+    chars = []
+    while True:
+        if position >= len(pattern):
+            raise ValueError('Unterminated class in {0}.'.format(pattern))
+        char = pattern[position]
+        if char == ']' and chars:
+            break
+        if char == '\\':
+            position += 1
+            if position >= len(pattern):
+                raise ValueError('Trailing \\ in {0}.'.format(pattern))
+            char = pattern[position]
+        if pattern.startswith('-', position + 1) and \
+                position + 2 < len(pattern) and pattern[position + 2] != ']':
+            last = pattern[position + 2]
+            if ord(last) < ord(char):
+                raise ValueError('Bad range {0}-{1} in {2}.'.format(
+                    char, last, pattern))
+            chars.extend(chr(code) for code in range(ord(char),
+                                                     ord(last) + 1))
+            position += 3
+        else:
+            chars.append(char)
+            position += 1
+    folded = set(_fold_class_character(char, fold) for char in chars)
+    return _Element(chars=frozenset(folded), negated=negated), position + 1
+
+
+def _parse_element(pattern, position, fold):
+    char = pattern[position]
+    if char == '?':
+        return _Element(), position + 1
+    if char == '[':
+        return _parse_class(pattern, position + 1, fold)
+    if char in '{}]':
+        raise ValueError('Unexpected {0} in {1}.'.format(char, pattern))
+    if char == '\\':
+        position += 1
+        if position >= len(pattern):
+            raise ValueError('Trailing \\ in {0}.'.format(pattern))
+        char = pattern[position]
+    return _Element(literal=fold(char)), position + 1
+
+
+def _parse(pattern, fold):
+    elements = []
+    position = 0
+    while position < len(pattern):
+        if pattern[position] == '{':
+            element, position = _parse_element(pattern, position + 1, fold)
+            if not pattern.startswith('}', position):
+                raise ValueError(
+                    'Optional parts must be one character in {0}.'.format(
+                        pattern))
+            element.optional = True
+            position += 1
+        else:
+            element, position = _parse_element(pattern, position, fold)
+        if element.literal == '':
+            # e.g. a combining mark of a normalized tree
+            continue
+        elements.append(element)
+    return elements
+
+
+class _Element(object):
+    '''
+    One character of a pattern. literal holds the folded character (which
+    can be longer than one character after folding), chars the characters
+    of a class. If both are None, the element matches any character.
+    '''
+
+    def __init__(self, literal=None, chars=None, negated=False):
+        self.literal = literal
+        self.chars = chars
+        self.negated = negated
+        self.optional = False
+
+    @property
+    def width(self):
+        return 1 if self.literal is None else len(self.literal)
+
+    def to_regex(self):
+        if self.literal is not None:
+            regex = re.escape(self.literal)
+        elif self.chars is not None:
+            regex = '[{0}{1}]'.format(
+                '^' if self.negated else '',
+                ''.join(re.escape(char) for char in sorted(self.chars)))
+        else:
+            regex = '.'
+        if self.optional:
+            if self.width > 1:
+                regex = '(?:{0})'.format(regex)
+            regex += '?'
+        return regex
+
+
+def _compile(elements):
+    # Matched with an endpos, which \Z matches, too
+    return re.compile(''.join(element.to_regex() for element in elements) +
+                      r'\Z', re.DOTALL)
+
+
+def _width_range(elements):
+    minimum = sum(element.width for element in elements
+                  if not element.optional)
+    return minimum, sum(element.width for element in elements)
+
+
+class Pattern(object):
+    '''
+    A compiled pattern. factors are the strings added to the trie, every
+    match of the pattern contains one of them (all of the same length).
+    Short classes are expanded into several factors, if that makes the
+    factors longer.
+    '''
+
+    def __init__(self, pattern, value, fold):
+        '''
+        @param fold: Function folding characters like the keywords of the
+                     tree are folded.
+        '''
+        self.pattern = pattern
+        self.value = value
+        elements = _parse(pattern, fold)
+        first, last = self._find_factor(elements)
+        if first is None:
+            raise ValueError(
+                'Pattern {0} needs at least one required character or'
+                ' class.'.format(pattern))
+        self.factors = [''.join(combination) for combination in product(
+            *[[element.literal] if element.literal is not None
+              else sorted(element.chars)
+              for element in elements[first:last]])]
+        self.factor_length = len(self.factors[0])
+        self._factor_set = frozenset(self.factors)
+        self._prefix = _compile(elements[:first])
+        self._prefix_range = _width_range(elements[:first])
+        self._suffix = _compile(elements[last:])
+        self._suffix_range = _width_range(elements[last:])
+        self.max_length = _width_range(elements)[1]
+
+    @staticmethod
+    def _find_factor(elements):
+        # Longest run of required elements that are literals or classes
+        # with at most MAX_FACTORS combinations. Longer factors are found
+        # less often by chance, so fewer of them have to be verified.
+        # Returns the slice of the elements.
+        best = (None, None)
+        best_length = 0
+        for first in range(len(elements)):
+            length = 0
+            combinations = 1
+            for last in range(first, len(elements)):
+                element = elements[last]
+                if element.optional or element.negated or \
+                        (element.literal is None and element.chars is None):
+                    break
+                if element.chars is not None:
+                    combinations *= len(element.chars)
+                    if combinations > MAX_FACTORS:
+                        break
+                length += element.width
+                if length > best_length:
+                    best = (first, last + 1)
+                    best_length = length
+        return best
+
+    def matches(self, text, start, end):
+        '''
+        Verifies the pattern around a factor found at text[start:end].
+        A match containing the factor several times (e.g. 'aa' for
+        '{a}a{a}') is only reported for its leftmost one.
+        @return: Generator of 2-Tuples with start and endindex of every
+                 match, by endindex and longest first (like the keywords
+                 found by KeywordTree.search_all).
+        '''
+        prefix = self._prefix
+        suffix = self._suffix
+        prefix_minimum, prefix_maximum = self._prefix_range
+        suffix_minimum, suffix_maximum = self._suffix_range
+        # Only with optional elements the factor can be at different
+        # positions of a match.
+        ambiguous = prefix_minimum != prefix_maximum or \
+            suffix_minimum != suffix_maximum
+        for match_end in range(end + suffix_minimum,
+                               min(end + suffix_maximum, len(text)) + 1):
+            if suffix.match(text, end, match_end) is None:
+                continue
+            for match_start in range(max(start - prefix_maximum, 0),
+                                     start - prefix_minimum + 1):
+                if prefix.match(text, match_start, start) is None:
+                    continue
+                if ambiguous and any(
+                        self._aligns(text, match_start, factor_start,
+                                     match_end)
+                        for factor_start in range(match_start, start)):
+                    continue
+                yield match_start, match_end
+
+    def _aligns(self, text, match_start, factor_start, match_end):
+        # Whether text[match_start:match_end] matches the pattern with the
+        # factor at factor_start
+        factor_end = factor_start + self.factor_length
+        return text[factor_start:factor_end] in self._factor_set and \
+            self._prefix.match(text, match_start, factor_start) is not None \
+            and self._suffix.match(text, factor_end, match_end) is not None
+
+
+class PatternFactor(object):
+    '''
+    Stored as keyword and value of the state of a factor. Holds the
+    patterns containing the factor and the keyword (if the factor was
+    added as keyword, too).
+    '''
+
+    def __init__(self, is_keyword=False, keyword=None, value=None):
+        self.is_keyword = is_keyword
+        self.keyword = keyword
+        self.value = value
+        self.patterns = []
+
+    def set_keyword(self, keyword, value):
+        self.is_keyword = True
+        self.keyword = keyword
+        self.value = value
+
+    def clear_keyword(self):
+        self.is_keyword = False
+        self.keyword = None
+        self.value = None
+
+
+def verify_patterns(results, text, values):
+    '''
+    Replaces the factors in the results of a search by the verified matches
+    of their patterns. The startindices of the results have to refer to
+    text.
+    '''
+    for result in results:
+        factor = result[0]
+        if factor.__class__ is not PatternFactor:
+            yield result
+            continue
+        start = result[1]
+        if factor.is_keyword:
+            if values:
+                yield (factor.value,) + result[1:]
+            else:
+                yield (factor.keyword, start)
+        for pattern in factor.patterns:
+            end = start + pattern.factor_length
+            for match_start, match_end in pattern.matches(text, start, end):
+                if values:
+                    yield (pattern.value, match_start, match_end)
+                else:
+                    yield (pattern.pattern, match_start)
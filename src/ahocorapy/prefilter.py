@@ -0,0 +1,114 @@
+'''
+Prefilter for texts in which keywords are rare.
+
+Every match starts with the first character of a keyword. The positions of
+these characters are found with a compiled regular expression, which scans
+the text at C speed. Only from there the trie is followed, so the
+characters in between are never looked at in python.
+'''
+
+from builtins import object
+from collections import Counter
+from heapq import heappop, heappush
+import re
+
+
+class Prefilter(object):
+    '''
+    Finds the keywords of a tree starting at the positions of their first
+    characters. Only pays off if these characters are rare in the texts.
+    '''
+
+    def __init__(self, zero_state, binary=False):
+        '''
+        @param zero_state: Zero state of a tree, which can be finalized or
+                           not (only the transitions of the trie are
+                           followed).
+        '''
+        self._zero_state = zero_state
+        first_characters = sorted(
+            symbol for symbol, child in zero_state.transitions.items()
+            if child.parent is zero_state)
+        if not first_characters:
+            self._regex = None
+        elif binary:
+            self._regex = re.compile(b'[' + b''.join(
+                re.escape(bytes(bytearray([symbol])))
+                for symbol in first_characters) + b']')
+        else:
+            self._regex = re.compile(u'[' + u''.join(
+                re.escape(symbol) for symbol in first_characters) + u']')
+
+    def _matches_at(self, text, start):
+        # States of all keywords starting at start, with the end of their
+        # match, shortest first.
+        state = self._zero_state
+        length = len(text)
+        idx = start
+        while idx < length:
+            next_state = state.transitions.get(text[idx])
+            if next_state is None or next_state.parent is not state:
+                break
+            state = next_state
+            idx += 1
+            if state.success:
+                yield state, idx
+
+    def search_all(self, text, values=False, is_word=None):
+        '''
+        Same results in the same order as KeywordTree._search_all, i.e. by
+        endindex and longest first.
+        '''
+        if self._regex is None:
+            return
+        length = len(text)
+        # Matches by endindex and startindex. Later candidates start
+        # further right, so matches ending before them are complete.
+        pending = []
+        for candidate in self._regex.finditer(text):
+            start = candidate.start()
+            while pending and pending[0][0] <= start:
+                yield self._result(heappop(pending), values)
+            if is_word is not None and start > 0 and is_word(text[start - 1]):
+                continue
+            for state, end in self._matches_at(text, start):
+                if is_word is not None and end < length and \
+                        is_word(text[end]):
+                    continue
+                heappush(pending, (end, start, state))
+        while pending:
+            yield self._result(heappop(pending), values)
+
+    @staticmethod
+    def _result(match, values):
+        end, start, state = match
+        if values:
+            return (state.value, start, end)
+        return (state.matched_keyword, start)
+
+    def contains(self, text):
+        '''
+        Same as KeywordTree.contains.
+        '''
+        if self._regex is None:
+            return False
+        for candidate in self._regex.finditer(text):
+            for _ in self._matches_at(text, candidate.start()):
+                return True
+        return False
+
+    def count(self, text, per_keyword=False):
+        '''
+        Same as KeywordTree.count.
+        '''
+        if self._regex is None:
+            return Counter() if per_keyword else 0
+        counts = Counter()
+        total = 0
+        for candidate in self._regex.finditer(text):
+            for state, _ in self._matches_at(text, candidate.start()):
+                if per_keyword:
+                    counts[state.matched_keyword] += 1
+                else:
+                    total += 1
+        return counts if per_keyword else total
@@ -3,6 +3,8 @@ from __future__ import print_function
 import time
 
 from pickle import loads, dumps
+import os
+import tempfile
 
 from ahocorapy.keywordtree import KeywordTree
 
@@ -31,3 +33,18 @@ load_end = time.time()
 
 print('Serialization took: {0:.2f}s\nDeserialization took: {1:.2f}s'.format(
     dump_end-dump_start, load_end-load_start))
+
+path = os.path.join(tempfile.mkdtemp(), 'names.ahocorapy')
+
+save_start = time.time()
+ahocorapy_tree.save(path)
+save_end = time.time()
+
+open_start = time.time()
+opened = KeywordTree.open(path)
+open_end = time.time()
+
+print('Saving took: {0:.2f}s\nOpening took: {1:.4f}s'.format(
+    save_end-save_start, open_end-open_start))
+os.remove(path)
+os.rmdir(os.path.dirname(path))
@@ -1,12 +1,22 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from builtins import str
-from io import open
+from builtins import chr, str
+from collections import Counter
+from io import BytesIO, StringIO, open
 from pickle import dumps, loads
+from random import Random
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
 
-from ahocorapy.keywordtree import KeywordTree
+from ahocorapy.keywordtree import KeywordTree, LEFTMOST_FIRST, \
+    LEFTMOST_LONGEST, NON_OVERLAPPING
+from ahocorapy.parallel import ParallelSearcher, ThreadSearcher
 
 
 class TestAhocorapy(unittest.TestCase):
@@ -201,9 +211,10 @@ class TestAhocorapy(unittest.TestCase):
 
         kwtree = KeywordTree(case_insensitive=True)
         kwtree.add('bla')
-        kwtree.finalize()
+        kwtree.finalize(compact=True)
 
         self.assertRaises(ValueError, kwtree.add, 'blueb')
+        self.assertRaises(ValueError, kwtree.remove, 'bla')
 
         kwtree = KeywordTree(case_insensitive=True)
         kwtree.add('bla')
@@ -316,6 +327,56 @@ class TestAhocorapy(unittest.TestCase):
         self.assertEqual(('frodo', 20), next(results))
         self.assertEqual(('gandalf', 31), next(results))
 
+    def test_unpickling_version_1(self):
+        # Tree with the keywords 'ab' and 'b' as pickled by ahocorapy < 1.7
+        serialized = {
+            'case_insensitive': False,
+            'finalized': True,
+            'counter': 4,
+            'states': [
+                {'symbol': None, 'success': False, 'parent': None,
+                 'matched_keyword': None, 'longest_strict_suffix': 0,
+                 'transitions': {'a': 1, 'b': 3}},
+                {'symbol': 'a', 'success': False, 'parent': 0,
+                 'matched_keyword': None, 'longest_strict_suffix': 0,
+                 'transitions': {'b': 2}},
+                {'symbol': 'b', 'success': True, 'parent': 1,
+                 'matched_keyword': 'ab', 'longest_strict_suffix': 3,
+                 'transitions': {}},
+                {'symbol': 'b', 'success': True, 'parent': 0,
+                 'matched_keyword': 'b', 'longest_strict_suffix': 0,
+                 'transitions': {}},
+            ]
+        }
+        tree = KeywordTree.__new__(KeywordTree)
+        tree.__setstate__(serialized)
+
+        results = tree.search_all('cabb')
+        self.assertEqual([('ab', 1), ('b', 2), ('b', 3)], list(results))
+
+        deserialized = loads(dumps(tree))
+        results = deserialized.search_all('cabb')
+        self.assertEqual([('ab', 1), ('b', 2), ('b', 3)], list(results))
+
+    def test_pickling_many_keywords(self):
+        kwtree = KeywordTree()
+        with open('tests/data/names.txt') as keyword_file:
+            keyword_list = list(map(str.strip, keyword_file.readlines()))
+        for keyword in keyword_list:
+            kwtree.add(keyword)
+        kwtree.finalize()
+        with open('tests/data/textblob.txt') as text_file:
+            textblob = text_file.read()
+
+        deserialized = loads(dumps(kwtree))
+
+        self.assertEqual(kwtree._counter, deserialized._counter)
+        self.assertEqual([('Dawn Higgins', 34153)],
+                         list(deserialized.search_all(textblob)))
+        text = ''.join(keyword_list[:100])
+        self.assertEqual(list(kwtree.search_all(text)),
+                         list(deserialized.search_all(text)))
+
     def test_state_to_string(self):
         words = ['peter', 'horst', 'gandalf', 'frodo']
         tree = KeywordTree(case_insensitive=True)
@@ -325,6 +386,1389 @@ class TestAhocorapy(unittest.TestCase):
         as_string = str(tree._zero_state)
         self.assertIsNotNone(as_string)
 
+    def test_compact_readme_example(self):
+        kwtree = KeywordTree(case_insensitive=True)
+        kwtree.add('malaga')
+        kwtree.add('lacrosse')
+        kwtree.add('mallorca')
+        kwtree.add('mallorca bella')
+        kwtree.add('orca')
+        kwtree.finalize(compact=True)
+
+        result = kwtree.search('My favorite islands are malaga and sylt.')
+        self.assertEqual(('malaga', 24), result)
+
+        results = kwtree.search_all('malheur on mallorca bellacrosse')
+        self.assertEqual([('mallorca', 11), ('orca', 15),
+                          ('mallorca bella', 11), ('lacrosse', 23)],
+                         list(results))
+
+        self.assertRaises(ValueError, kwtree.add, 'sylt')
+
+    def test_compact_same_results(self):
+        words = ['/bar', '/foo/bar', 'bar', 'foo/', 'foo', '/foo/', 'aaaamen',
+                 'blaaaaaf', 'uebergaaat', u'颜到', 'a']
+        text = u'/foo/bar clueuebergaaameblaaaamenbluez 春华变苍颜到处群魔乱'
+        kwtree = KeywordTree()
+        compact_tree = KeywordTree()
+        for word in words:
+            kwtree.add(word)
+            compact_tree.add(word)
+        kwtree.finalize()
+        compact_tree.finalize(compact=True)
+
+        self.assertEqual(list(kwtree.search_all(text)),
+                         list(compact_tree.search_all(text)))
+
+    def test_compact_pickling(self):
+        words = ['peter', 'horst', 'gandalf', 'frodo']
+        tree = KeywordTree(case_insensitive=True)
+        for word in words:
+            tree.add(word)
+        tree.finalize(compact=True)
+
+        deserialized = loads(dumps(tree))
+
+        text = 'Gollum did not like frodo. But gandalf did.'
+        results = deserialized.search_all(text)
+        self.assertEqual(('frodo', 20), next(results))
+        self.assertEqual(('gandalf', 31), next(results))
+
+    def test_minimize(self):
+        words = ['a.example.com', 'b.example.com', 'ab.example.com',
+                 'example.com', 'x.example.net', 'cd.example.net']
+        text = 'see a.example.com, ab.example.com and cd.example.net'
+        kwtree = KeywordTree.from_keywords(words, compact=True)
+        minimized = KeywordTree()
+        for word in words:
+            minimized.add(word, word.upper())
+        self.assertEqual(12, minimized.finalize(minimize=True))
+        self.assertEqual(len(kwtree._compact) - 12, len(minimized._compact))
+
+        self.assertEqual(
+            [('a.example.com', 4), ('example.com', 6),
+             ('ab.example.com', 19), ('b.example.com', 20),
+             ('example.com', 22), ('cd.example.net', 38)],
+            list(minimized.search_all(text)))
+        self.assertEqual(list(kwtree.search_all(text)),
+                         list(minimized.search_all(text)))
+        self.assertEqual(('A.EXAMPLE.COM', 4, 17),
+                         next(minimized.search_all(text, values=True)))
+        for mode in (NON_OVERLAPPING, LEFTMOST_LONGEST, LEFTMOST_FIRST):
+            self.assertEqual(list(kwtree.search_all(text, mode=mode)),
+                             list(minimized.search_all(text, mode=mode)))
+        self.assertEqual(kwtree.count(text, per_keyword=True),
+                         minimized.count(text, per_keyword=True))
+        self.assertEqual(list(kwtree.search_many([text, 'b.example.com'])),
+                         list(minimized.search_many([text, 'b.example.com'])))
+        self.assertEqual(list(kwtree.search_all(text)),
+                         list(loads(dumps(minimized)).search_all(text)))
+        self.assertRaises(ValueError, minimized.search_stream, [text])
+        self.assertRaises(ValueError, minimized.scanner)
+
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'tree.ahocorapy')
+            minimized.save(path)
+            opened = KeywordTree.open(path)
+            self.assertEqual(list(minimized.search_all(text, values=True)),
+                             list(opened.search_all(text, values=True)))
+        finally:
+            shutil.rmtree(directory)
+
+        kwtree = KeywordTree(binary=True, case_insensitive=True)
+        for word in words:
+            kwtree.add(word.encode('ascii'))
+        kwtree.finalize(minimize=True)
+        self.assertEqual([(b'a.example.com', 0), (b'example.com', 2)],
+                         list(kwtree.search_all(
+                             bytearray(b'A.EXAMPLE.COM'))))
+
+        kwtree = KeywordTree()
+        kwtree.add_pattern('a?c')
+        self.assertRaises(ValueError, kwtree.finalize, minimize=True)
+
+    def test_minimize_random(self):
+        # Minimized trees have to find exactly the same matches
+        rand = Random(22)
+        for _ in range(100):
+            words = [''.join(rand.choice('abc') for _ in
+                             range(rand.randint(1, 6)))
+                     for _ in range(rand.randint(1, 12))]
+            text = ''.join(rand.choice('abcAB ') for _ in range(60))
+            options = {'case_insensitive': rand.random() < 0.3,
+                       'word_boundaries': rand.random() < 0.3}
+            kwtree = KeywordTree.from_keywords(words, presorted=True,
+                                               **options)
+            minimized = KeywordTree.from_keywords(words, presorted=True,
+                                                  minimize=True, **options)
+            for mode in (None, NON_OVERLAPPING, LEFTMOST_LONGEST,
+                         LEFTMOST_FIRST):
+                kwargs = {} if mode is None else {'mode': mode}
+                self.assertEqual(list(kwtree.search_all(text, **kwargs)),
+                                 list(minimized.search_all(text, **kwargs)))
+
+    def test_dense(self):
+        words = ['/bar', '/foo/bar', 'bar', 'foo/', 'foo', '/foo/', 'aaaamen',
+                 'blaaaaaf', 'uebergaaat', u'颜到', 'a']
+        text = u'/foo/bar clueuebergaaameblaaaamenbluez 春华变苍颜到处群魔乱'
+        kwtree = KeywordTree()
+        dense_tree = KeywordTree()
+        for word in words:
+            kwtree.add(word, word.upper())
+            dense_tree.add(word, word.upper())
+        kwtree.finalize()
+        dense_tree.finalize(dense=True)
+
+        for values in (False, True):
+            self.assertEqual(list(kwtree.search_all(text, values=values)),
+                             list(dense_tree.search_all(text, values=values)))
+        self.assertTrue(dense_tree.contains(text))
+        self.assertFalse(dense_tree.contains(u'春华变苍'))
+        self.assertEqual(kwtree.count(text, per_keyword=True),
+                         dense_tree.count(text, per_keyword=True))
+        chunks = [text[idx:idx + 3] for idx in range(0, len(text), 3)]
+        self.assertEqual(list(kwtree.search_all(text)),
+                         list(dense_tree.search_stream(chunks)))
+
+        # The table is rebuilt after changes
+        kwtree.add('clue')
+        dense_tree.add('clue')
+        self.assertTrue(dense_tree.remove('bar'))
+        kwtree.remove('bar')
+        self.assertEqual(list(kwtree.search_all(text)),
+                         list(dense_tree.search_all(text)))
+        self.assertEqual(list(kwtree.search_all(text)),
+                         list(loads(dumps(dense_tree)).search_all(text)))
+
+        # Every byte occurs in a keyword, there is no class of other bytes
+        all_bytes = bytes(bytearray(range(256)))
+        kwtree = KeywordTree(binary=True)
+        kwtree.add(b'abc')
+        kwtree.add(all_bytes)
+        kwtree.finalize(dense=True)
+        self.assertEqual([(b'abc', 2), (b'abc', 102), (all_bytes, 5)],
+                         list(kwtree.search_all(memoryview(
+                             b'xxabc' + all_bytes))))
+
+        self.assertRaises(ValueError, KeywordTree().finalize, compact=True,
+                          dense=True)
+        self.assertRaises(ValueError, KeywordTree(shortcuts=False).finalize,
+                          dense=True)
+
+    def test_prefilter(self):
+        words = ['/bar', '/foo/bar', 'bar', 'foo/', 'foo', '/foo/', 'aaaamen',
+                 'blaaaaaf', 'uebergaaat', u'颜到', 'a', '[a]', '^-\\']
+        text = u'/foo/bar clue[a]^-\\ergaaameblaaaamenbluez 春华变苍颜到处群魔乱'
+        kwtree = KeywordTree()
+        prefilter_tree = KeywordTree()
+        for word in words:
+            kwtree.add(word, word.upper())
+            prefilter_tree.add(word, word.upper())
+        kwtree.finalize()
+        prefilter_tree.finalize(prefilter=True)
+
+        for values in (False, True):
+            self.assertEqual(list(kwtree.search_all(text, values=values)),
+                             list(prefilter_tree.search_all(text,
+                                                            values=values)))
+        self.assertTrue(prefilter_tree.contains(text))
+        self.assertFalse(prefilter_tree.contains(u'春华变苍'))
+        self.assertEqual(kwtree.count(text, per_keyword=True),
+                         prefilter_tree.count(text, per_keyword=True))
+        self.assertEqual(kwtree.count(text), prefilter_tree.count(text))
+        chunks = [text[idx:idx + 3] for idx in range(0, len(text), 3)]
+        self.assertEqual(list(kwtree.search_all(text)),
+                         list(prefilter_tree.search_stream(chunks)))
+
+        # The prefilter is rebuilt after changes
+        kwtree.add('clue')
+        prefilter_tree.add('clue')
+        self.assertTrue(prefilter_tree.remove('bar'))
+        kwtree.remove('bar')
+        self.assertEqual(list(kwtree.search_all(text)),
+                         list(prefilter_tree.search_all(text)))
+        self.assertEqual(list(kwtree.search_all(text)),
+                         list(loads(dumps(prefilter_tree)).search_all(text)))
+
+        empty_tree = KeywordTree()
+        empty_tree.finalize(prefilter=True)
+        self.assertEqual([], list(empty_tree.search_all(text)))
+        self.assertFalse(empty_tree.contains(text))
+        self.assertEqual(0, empty_tree.count(text))
+
+        kwtree = KeywordTree(binary=True)
+        kwtree.add(b'a]c')
+        kwtree.add(b'\x00\xff')
+        kwtree.finalize(prefilter=True)
+        self.assertEqual([(b'a]c', 2), (b'\x00\xff', 5)],
+                         list(kwtree.search_all(memoryview(
+                             b'xxa]c\x00\xff'))))
+
+        self.assertRaises(ValueError, KeywordTree().finalize, compact=True,
+                          prefilter=True)
+
+    def test_prefilter_random(self):
+        rand = Random(24)
+        alphabet = u'abcAé.'
+        for _ in range(100):
+            words = set(''.join(rand.choice(alphabet)
+                                for _ in range(rand.randint(1, 4)))
+                        for _ in range(rand.randint(1, 8)))
+            options = {'case_insensitive': rand.random() < 0.3,
+                       'normalize': rand.random() < 0.3,
+                       'word_boundaries': rand.random() < 0.3,
+                       'shortcuts': rand.random() < 0.7}
+            kwtree = KeywordTree(**options)
+            prefilter_tree = KeywordTree(**options)
+            for word in words:
+                kwtree.add(word)
+                prefilter_tree.add(word)
+            kwtree.finalize()
+            prefilter_tree.finalize(prefilter=True)
+            for _ in range(5):
+                text = ''.join(rand.choice(alphabet + u' xy')
+                               for _ in range(rand.randint(0, 30)))
+                self.assertEqual(list(kwtree.search_all(text)),
+                                 list(prefilter_tree.search_all(text)))
+                self.assertEqual(kwtree.count(text, per_keyword=True),
+                                 prefilter_tree.count(text, per_keyword=True))
+                self.assertEqual(kwtree.contains(text),
+                                 prefilter_tree.contains(text))
+
+    def test_without_shortcuts(self):
+        words = ['/bar', '/foo/bar', 'bar', 'foo/', 'foo', '/foo/', 'aaaamen',
+                 'blaaaaaf', 'uebergaaat', u'颜到', 'a']
+        text = u'/foo/bar clueuebergaaameblaaaamenbluez 春华变苍颜到处群魔乱'
+        kwtree = KeywordTree()
+        lazy_tree = KeywordTree(shortcuts=False)
+        for word in words:
+            kwtree.add(word)
+            lazy_tree.add(word)
+        kwtree.finalize()
+        lazy_tree.finalize()
+
+        expected = list(kwtree.search_all(text))
+        self.assertEqual(expected, list(lazy_tree.search_all(text)))
+
+        for state in lazy_tree._zero_state.transitions.values():
+            for child in state.transitions.values():
+                self.assertIs(state, child.parent)
+
+        deserialized = loads(dumps(lazy_tree))
+        self.assertEqual(expected, list(deserialized.search_all(text)))
+
+    def test_search_many(self):
+        texts = ['malheur on mallorca bellacrosse', '', 'sylt',
+                 'My favorite islands are malaga and sylt.']
+        for options in ({}, {'shortcuts': False}, {'compact': True}):
+            kwtree = KeywordTree(case_insensitive=True,
+                                 shortcuts=options.get('shortcuts', True))
+            kwtree.add('malaga')
+            kwtree.add('lacrosse')
+            kwtree.add('mallorca')
+            kwtree.add('mallorca bella')
+            kwtree.add('orca')
+            kwtree.finalize(compact=options.get('compact', False))
+
+            results = kwtree.search_many(iter(texts))
+            self.assertEqual([(0, 'mallorca', 11), (0, 'orca', 15),
+                              (0, 'mallorca bella', 11), (0, 'lacrosse', 23),
+                              (3, 'malaga', 24)], list(results))
+
+            results = kwtree.search_one_many(texts)
+            self.assertEqual([(0, 'mallorca', 11), (3, 'malaga', 24)],
+                             list(results))
+
+        kwtree = KeywordTree()
+        kwtree.add('bla')
+        self.assertRaises(ValueError, kwtree.search_many, ['bla'])
+
+    def test_parallel_search(self):
+        kwtree = KeywordTree()
+        for keyword in ['bla', 'blaaaaaf', 'aaaamen', 'la', 'f', u'颜到']:
+            kwtree.add(keyword)
+        kwtree.finalize()
+        text = u'blaaaaaf aaaamenblaaaaaf 颜到 blaaaamen' * 20
+        texts = [text[idx:idx + 13] for idx in range(0, len(text), 7)]
+
+        with ParallelSearcher(kwtree, processes=2, batch_size=5,
+                              chunk_size=10) as searcher:
+            self.assertEqual(list(kwtree.search_all(text)),
+                             list(searcher.search_all(text)))
+            self.assertEqual(list(kwtree.search_many(texts)),
+                             list(searcher.search_many(texts)))
+
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'tree.ahocorapy')
+            kwtree.save(path)
+            with ParallelSearcher(KeywordTree.open(path), processes=2,
+                                  chunk_size=10) as searcher:
+                self.assertEqual(list(kwtree.search_all(text)),
+                                 list(searcher.search_all(text)))
+        finally:
+            shutil.rmtree(directory)
+
+        # Matches are longer than their keywords in the lowercased text
+        kwtree = KeywordTree(case_insensitive=True)
+        kwtree.add(u'İb')
+        kwtree.finalize()
+        text = u'xi̇b' * 3
+        with ParallelSearcher(kwtree, processes=2, chunk_size=3) as searcher:
+            self.assertEqual(list(kwtree.search_all(text)),
+                             list(searcher.search_all(text)))
+
+        kwtree = KeywordTree(normalize=True)
+        kwtree.add(u'cafe')
+        kwtree.finalize()
+        with ParallelSearcher(kwtree, processes=1, chunk_size=4) as searcher:
+            self.assertRaises(ValueError, searcher.search_all, u'xćáf́éy')
+            self.assertEqual(list(kwtree.search_many([u'xćáf́éy'])),
+                             list(searcher.search_many([u'xćáf́éy'])))
+
+    def test_freeze(self):
+        kwtree = KeywordTree(shortcuts=False)
+        kwtree.add('bla')
+        self.assertRaises(ValueError, kwtree.freeze)
+        kwtree.finalize()
+        self.assertIs(kwtree, kwtree.freeze())
+        self.assertIs(kwtree, kwtree.freeze())
+        self.assertEqual([('bla', 2)], list(kwtree.search_all('xxbla')))
+        self.assertRaises(ValueError, kwtree.add, 'blub')
+        self.assertRaises(ValueError, kwtree.add_pattern, 'bl?b')
+        self.assertRaises(ValueError, kwtree.remove, 'bla')
+        self.assertRaises(ValueError, kwtree.finalize)
+        self.assertEqual([('bla', 2)], list(kwtree.search_all('xxbla')))
+        # Copies can be changed again
+        copied = loads(dumps(kwtree))
+        copied.add('blub')
+        self.assertEqual([('blub', 0)], list(copied.search_all('blub')))
+
+        kwtree = KeywordTree(case_insensitive=True)
+        for keyword in ['bla', 'Blub', 'la']:
+            kwtree.add(keyword, keyword.upper())
+        kwtree.finalize(minimize=True)
+        kwtree.freeze()
+        self.assertIsNotNone(kwtree._compact._depths)
+        self.assertIsNotNone(kwtree._compact._keyword_index)
+        self.assertEqual([('bla', 0), ('la', 1), ('Blub', 4)],
+                         list(kwtree.search_all('BLA blub')))
+
+        # Searching doesn't add characters to the tables anymore
+        kwtree = KeywordTree(normalize=True)
+        kwtree.add(u'café')
+        kwtree.finalize(dense=True)
+        list(kwtree.search_fuzzy(u'cafe'))
+        kwtree.freeze()
+        folds = kwtree._folding._folds
+        classes = kwtree._dense_table._table
+        sizes = (len(folds), len(classes))
+        text = u''.join(chr(code) for code in range(0x4e00, 0x4e00 + 5000))
+        self.assertEqual([(u'café', 5000)],
+                         list(kwtree.search_all(text + u'cafe')))
+        self.assertEqual(sizes, (len(folds), len(classes)))
+        self.assertEqual([(u'café', 0, 1)],
+                         list(kwtree.search_fuzzy(u'cafx', max_edits=1)))
+        self.assertEqual([(u'café', 0, 2)],
+                         list(kwtree.search_fuzzy(u'cxfx', max_edits=2)))
+        self.assertEqual([(1, False)], list(kwtree._fuzzy_matchers))
+
+    def test_concurrent_search(self):
+        words = ['/bar', '/foo/bar', 'bar', 'foo/', 'foo', '/foo/', 'aaaamen',
+                 'blaaaaaf', 'uebergaaat', u'颜到', 'a']
+        text = u'/foo/bar clueuebergaaameblaaaamenbluez 春华变苍颜到处群魔乱' * 20
+        texts = [text[idx:idx + 13] for idx in range(0, len(text), 7)]
+        trees = []
+        for options, finalize_options in (
+                ({}, {}), ({'shortcuts': False}, {}),
+                ({}, {'dense': True}), ({}, {'prefilter': True}),
+                ({'word_boundaries': True}, {}), ({}, {'minimize': True})):
+            kwtree = KeywordTree(**options)
+            for word in words:
+                kwtree.add(word)
+            kwtree.finalize(**finalize_options)
+            trees.append(kwtree.freeze())
+        expected = [(list(kwtree.search_all(text)),
+                     list(kwtree.search_many(texts)),
+                     kwtree.count(text, per_keyword=True))
+                    for kwtree in trees]
+
+        errors = []
+        start = threading.Event()
+
+        def search():
+            start.wait()
+            try:
+                for _ in range(10):
+                    for kwtree, results in zip(trees, expected):
+                        self.assertEqual(results, (
+                            list(kwtree.search_all(text)),
+                            list(kwtree.search_many(texts)),
+                            kwtree.count(text, per_keyword=True)))
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=search) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+
+        kwtree = trees[0]
+        with ThreadSearcher(kwtree, threads=4, batch_size=5,
+                            chunk_size=10) as searcher:
+            self.assertEqual(expected[0][0], list(searcher.search_all(text)))
+            self.assertEqual(expected[0][1],
+                             list(searcher.search_many(texts)))
+        kwtree = KeywordTree()
+        kwtree.add('bla')
+        kwtree.finalize()
+        ThreadSearcher(kwtree, threads=1).close()
+        self.assertRaises(ValueError, kwtree.add, 'blub')
+
+    def test_search_stream(self):
+        text = u'blaaaaaf aaaamenblaaaaaf 颜到 blaaaamen'
+        for options in ({}, {'shortcuts': False}, {'compact': True}):
+            kwtree = KeywordTree(shortcuts=options.get('shortcuts', True))
+            for keyword in ['bla', 'blaaaaaf', 'aaaamen', 'la', u'颜到']:
+                kwtree.add(keyword)
+            kwtree.finalize(compact=options.get('compact', False))
+            expected = list(kwtree.search_all(text))
+
+            chunks = [text[idx:idx + 3] for idx in range(0, len(text), 3)]
+            self.assertEqual(expected, list(kwtree.search_stream(chunks)))
+
+            results = kwtree.search_stream(StringIO(text), chunk_size=2)
+            self.assertEqual(expected, list(results))
+
+            encoded = BytesIO(text.encode('utf-8'))
+            results = kwtree.search_stream(encoded, encoding='utf-8',
+                                           chunk_size=1)
+            self.assertEqual(expected, list(results))
+
+    def test_search_stream_folded(self):
+        kwtree = KeywordTree(case_insensitive=True)
+        kwtree.add(u'İb')
+        kwtree.finalize()
+        self.assertEqual([(u'İb', 1)],
+                         list(kwtree.search_stream([u'xİ', u'b'])))
+        kwtree = KeywordTree(normalize=True)
+        kwtree.add(u'ﬁx')
+        kwtree.finalize()
+        self.assertEqual([(u'ﬁx', 2), (u'ﬁx', 5)],
+                         list(kwtree.search_stream([u'a ﬁ', u'x fix'])))
+
+        rand = Random(18)
+        alphabet = u'aAfiİﬁxé'
+        for _ in range(50):
+            options = {'case_insensitive': rand.random() < 0.5,
+                       'normalize': rand.random() < 0.5}
+            compact = rand.random() < 0.3
+            kwtree = KeywordTree(**options)
+            for _ in range(rand.randint(1, 5)):
+                kwtree.add(''.join(rand.choice(alphabet)
+                                   for _ in range(rand.randint(1, 4))))
+            kwtree.finalize(compact=compact)
+            text = ''.join(rand.choice(alphabet)
+                           for _ in range(rand.randint(0, 30)))
+            chunks = []
+            position = 0
+            while position < len(text):
+                size = rand.randint(1, 4)
+                chunks.append(text[position:position + size])
+                position += size
+            for values in (False, True):
+                expected = list(kwtree.search_all(text, values=values))
+                self.assertEqual(expected, list(kwtree.search_stream(
+                    chunks, values=values)))
+                scanner = kwtree.scanner(values=values)
+                self.assertEqual(expected, [result for chunk in chunks
+                                            for result in scanner.feed(chunk)])
+
+    def test_scanner(self):
+        text = u'blaaaaaf aaaamenblaaaaaf 颜到 blaaaamen'
+        for options in ({}, {'shortcuts': False}, {'compact': True}):
+            kwtree = KeywordTree(shortcuts=options.get('shortcuts', True))
+            for keyword in ['bla', 'blaaaaaf', 'aaaamen', 'la', u'颜到']:
+                kwtree.add(keyword)
+            kwtree.finalize(compact=options.get('compact', False))
+            expected = list(kwtree.search_all(text))
+
+            scanner = kwtree.scanner()
+            results = scanner.feed(text[:12])
+            self.assertEqual(12, scanner.position)
+            # Continue with a new scanner from the stored state
+            resumed = kwtree.scanner(scanner.state, scanner.position)
+            results += resumed.feed(text[12:20])
+            results += resumed.feed(text[20:])
+            self.assertEqual(expected, results)
+            self.assertEqual(len(text), resumed.position)
+
+            resumed.reset()
+            self.assertEqual(0, resumed.position)
+            self.assertEqual(expected, resumed.feed(text))
+
+            self.assertRaises(ValueError, kwtree.scanner, -1)
+
+        # States have the same identifiers in copies of a tree
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'tree.ahocorapy')
+            kwtree = KeywordTree()
+            for keyword in ['xyz', 'abcdef', 'abq']:
+                kwtree.add(keyword)
+            kwtree.finalize()
+            kwtree.save(path)
+            scanner = kwtree.scanner()
+            self.assertEqual([], scanner.feed('abcd'))
+            compact_tree = KeywordTree()
+            for keyword in ['abq', 'abcdef', 'xyz']:
+                compact_tree.add(keyword)
+            compact_tree.finalize(compact=True)
+            for copy in (loads(dumps(kwtree)), compact_tree,
+                         KeywordTree.open(path)):
+                resumed = copy.scanner(scanner.state, scanner.position)
+                self.assertEqual([('abcdef', 0)], resumed.feed('ef'))
+        finally:
+            shutil.rmtree(directory)
+
+        # Folded characters before position need the history
+        for compact in (False, True):
+            kwtree = KeywordTree(case_insensitive=True)
+            kwtree.add(u'i\u0307x')
+            kwtree.add(u'a\u0130x')
+            kwtree.finalize(compact=compact)
+            self.assertIn((u'a\u0130x', 0), kwtree.search_all(u'a\u0130x'))
+            scanner = kwtree.scanner()
+            self.assertEqual([], scanner.feed(u'a\u0130'))
+            if len(u'\u0130'.lower()) == 2:
+                self.assertRaises(ValueError, kwtree.scanner, scanner.state,
+                                  scanner.position)
+            resumed = kwtree.scanner(scanner.state, scanner.position,
+                                     history=scanner.history)
+            self.assertEqual(list(kwtree.search_all(u'a\u0130x')),
+                             resumed.feed(u'x'))
+
+    @unittest.skipIf(sys.version_info < (3, 7), 'asyncio helpers need 3.7')
+    def test_aio(self):
+        import asyncio
+        from ahocorapy.aio import AsyncSearcher, search_chunks
+
+        class Chunks(object):
+            def __init__(self, chunks):
+                self._chunks = iter(chunks)
+
+            def __aiter__(self):
+                return self
+
+            def __anext__(self):
+                for chunk in self._chunks:
+                    return asyncio.sleep(0, result=chunk)
+                raise StopAsyncIteration
+
+        def collect(async_generator):
+            results = []
+            while True:
+                try:
+                    results.append(
+                        loop.run_until_complete(async_generator.__anext__()))
+                except StopAsyncIteration:
+                    return results
+
+        kwtree = KeywordTree()
+        for keyword in ['bla', 'blaaaaaf', 'aaaamen', 'la', u'颜到']:
+            kwtree.add(keyword)
+        kwtree.finalize()
+        text = u'blaaaaaf aaaamenblaaaaaf 颜到 blaaaamen'
+        expected = list(kwtree.search_all(text))
+        chunks = [text[idx:idx + 7] for idx in range(0, len(text), 7)]
+
+        loop = asyncio.new_event_loop()
+        try:
+            results = collect(search_chunks(kwtree, Chunks(chunks),
+                                            slice_size=3))
+            self.assertEqual(expected, results)
+
+            for options in ({}, {'processes': 1}):
+                searcher = AsyncSearcher(kwtree, **options)
+                self.assertEqual(expected, loop.run_until_complete(
+                    searcher.search_all(text)))
+                self.assertEqual(list(kwtree.search_many(chunks)),
+                                 loop.run_until_complete(
+                                     searcher.search_many(chunks)))
+                searcher.close()
+        finally:
+            loop.close()
+
+    def test_binary(self):
+        text = u'Malheur on Mallorca bellacrosse 春华变苍颜到处群魔乱'
+        data = text.encode('utf-8')
+        expected = [(b'mallorca', 11), (b'orca', 15),
+                    (b'mallorca bella', 11), (b'lacrosse', 23),
+                    (u'颜到'.encode('utf-8'), 44)]
+        for options in ({}, {'shortcuts': False}, {'compact': True}):
+            kwtree = KeywordTree(case_insensitive=True, binary=True,
+                                 shortcuts=options.get('shortcuts', True))
+            kwtree.add(b'malaga')
+            kwtree.add(b'lacrosse')
+            kwtree.add(b'mallorca')
+            kwtree.add(b'mallorca bella')
+            kwtree.add(b'orca')
+            kwtree.add(u'颜到')
+            kwtree.finalize(compact=options.get('compact', False))
+
+            self.assertEqual(expected, list(kwtree.search_all(data)))
+            self.assertEqual(expected,
+                             list(kwtree.search_all(bytearray(data))))
+            self.assertEqual(expected,
+                             list(kwtree.search_all(memoryview(data))))
+            self.assertEqual(expected,
+                             list(loads(dumps(kwtree)).search_all(data)))
+            self.assertEqual(expected,
+                             list(kwtree.search_stream(BytesIO(data),
+                                                       chunk_size=3)))
+
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'tree.ahocorapy')
+            kwtree.save(path)
+            opened = KeywordTree.open(path)
+            self.assertEqual(expected, list(opened.search_all(data)))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_add_and_remove_after_finalize(self):
+        random = Random(42)
+        alphabet = 'abc'
+
+        def random_word(max_length):
+            return ''.join(random.choice(alphabet)
+                           for _ in range(random.randint(1, max_length)))
+
+        texts = [random_word(40) for _ in range(20)]
+        for shortcuts in (True, False):
+            keywords = set(random_word(5) for _ in range(10))
+            kwtree = KeywordTree(shortcuts=shortcuts)
+            for keyword in keywords:
+                kwtree.add(keyword)
+            kwtree.finalize()
+            for _ in range(60):
+                if keywords and random.random() < 0.3:
+                    keyword = random.choice(sorted(keywords))
+                    keywords.remove(keyword)
+                    self.assertTrue(kwtree.remove(keyword))
+                    self.assertFalse(kwtree.remove(keyword))
+                else:
+                    keyword = random_word(6)
+                    keywords.add(keyword)
+                    kwtree.add(keyword)
+
+                expected_tree = KeywordTree()
+                for keyword in keywords:
+                    expected_tree.add(keyword)
+                expected_tree.finalize()
+                for text in texts:
+                    self.assertEqual(list(expected_tree.search_all(text)),
+                                     list(kwtree.search_all(text)))
+
+    def test_add_after_finalize_new_first_character(self):
+        with open('tests/data/names.txt') as keyword_file:
+            keyword_list = [keyword.strip() for keyword in keyword_file]
+        kwtree = KeywordTree()
+        for keyword in keyword_list:
+            kwtree.add(keyword)
+        start = time.time()
+        kwtree.finalize()
+        finalize_time = time.time() - start
+        # Builds the indexes used for additions
+        kwtree.add(u'\u0400Dawn')
+
+        # Keywords starting with a character that no keyword starts with
+        # so far are added without looking at all states.
+        start = time.time()
+        for idx in range(100):
+            kwtree.add(chr(0x401 + idx) + keyword_list[idx][:6])
+        self.assertLess(time.time() - start, finalize_time)
+
+        text = u'x\u0400Dawn Higgins' + chr(0x401) + keyword_list[0]
+        expected_tree = KeywordTree()
+        for keyword in keyword_list + [u'\u0400Dawn', chr(0x401) +
+                                       keyword_list[0][:6]]:
+            expected_tree.add(keyword)
+        expected_tree.finalize()
+        self.assertEqual(list(expected_tree.search_all(text)),
+                         list(kwtree.search_all(text)))
+
+    def test_add_after_finalize_readme_example(self):
+        kwtree = KeywordTree(case_insensitive=True)
+        kwtree.add('malaga')
+        kwtree.add('mallorca bella')
+        kwtree.finalize()
+        kwtree.add('lacrosse')
+        kwtree.add('orca')
+        kwtree.add('mallorca')
+
+        results = kwtree.search_all('malheur on mallorca bellacrosse')
+        self.assertEqual([('mallorca', 11), ('orca', 15),
+                          ('mallorca bella', 11), ('lacrosse', 23)],
+                         list(results))
+
+        self.assertTrue(kwtree.remove('Orca'))
+        self.assertFalse(kwtree.remove('sylt'))
+        results = kwtree.search_all('malheur on mallorca bellacrosse')
+        self.assertEqual([('mallorca', 11), ('mallorca bella', 11),
+                          ('lacrosse', 23)], list(results))
+
+    def test_save_and_open(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'tree.ahocorapy')
+            kwtree = KeywordTree(case_insensitive=True)
+            kwtree.add('malaga')
+            kwtree.add('lacrosse')
+            kwtree.add('mallorca')
+            kwtree.add('mallorca bella')
+            kwtree.add(u'颜到')
+            kwtree.finalize()
+            kwtree.save(path)
+
+            opened = KeywordTree.open(path)
+            text = u'Malheur on Mallorca bellacrosse 春华变苍颜到处群魔乱'
+            self.assertEqual(list(kwtree.search_all(text)),
+                             list(opened.search_all(text)))
+            self.assertRaises(ValueError, opened.add, 'sylt')
+
+            copied = loads(dumps(opened))
+            self.assertEqual(list(kwtree.search_all(text)),
+                             list(copied.search_all(text)))
+
+            opened.save(os.path.join(directory, 'copy.ahocorapy'))
+            reopened = KeywordTree.open(
+                os.path.join(directory, 'copy.ahocorapy'))
+            self.assertEqual(list(kwtree.search_all(text)),
+                             list(reopened.search_all(text)))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_open_invalid_file(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'tree.ahocorapy')
+            with open(path, 'wb') as invalid_file:
+                invalid_file.write(b'no ahocorapy tree, but long enough')
+            self.assertRaises(ValueError, KeywordTree.open, path)
+
+            # Truncated files, also on the boundaries of the items
+            kwtree = KeywordTree()
+            for keyword in ['bla', 'blaaaaaf', 'aaaamen', u'颜到']:
+                kwtree.add(keyword)
+            kwtree.finalize()
+            kwtree.save(path)
+            with open(path, 'rb') as tree_file:
+                data = tree_file.read()
+            for length in range(1, len(data)):
+                with open(path, 'wb') as truncated_file:
+                    truncated_file.write(data[:length])
+                self.assertRaises(ValueError, KeywordTree.open, path)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_long_overlapping_keywords(self):
+        for shortcuts in (True, False):
+            kwtree = KeywordTree(shortcuts=shortcuts)
+            kwtree.add('a' * 3000)
+            kwtree.add('b' + 'a' * 3000)
+            kwtree.add('ab')
+            kwtree.finalize()
+
+            results = kwtree.search_all('b' + 'a' * 3001 + 'b')
+            self.assertEqual([('b' + 'a' * 3000, 0), ('a' * 3000, 1),
+                              ('a' * 3000, 2), ('ab', 3001)],
+                             list(results))
+
+    def test_from_keywords(self):
+        keywords = ['malaga', 'lacrosse', 'mallorca', 'mallorca bella',
+                    'orca', 'Orca', '', 'mal', 'malaga']
+        text = 'malheur on mallorca bellacrosse and malaga'
+        for case_insensitive in (False, True):
+            expected_tree = KeywordTree(case_insensitive=case_insensitive)
+            for keyword in keywords:
+                expected_tree.add(keyword)
+            expected_tree.finalize()
+            expected = list(expected_tree.search_all(text))
+
+            for presorted in (False, True):
+                for compact in (False, True):
+                    kwtree = KeywordTree.from_keywords(
+                        (keyword for keyword in keywords), presorted,
+                        compact, case_insensitive=case_insensitive)
+                    self.assertEqual(expected, list(kwtree.search_all(text)))
+            kwtree = KeywordTree.from_keywords(
+                iter(sorted(keywords, key=lambda keyword: keyword.lower())),
+                presorted=True, case_insensitive=case_insensitive)
+            self.assertEqual(expected, list(kwtree.search_all(text)))
+            self.assertEqual(expected_tree._counter, kwtree._counter)
+
+    def test_from_keywords_binary(self):
+        kwtree = KeywordTree.from_keywords(
+            [b'mallorca', 'orca', b'mal'], binary=True, shortcuts=False)
+        self.assertEqual([(b'mal', 0), (b'mallorca', 0), (b'orca', 4)],
+                         list(kwtree.search_all(b'mallorca')))
+
+    def test_values(self):
+        text = u'malheur on mallorca bellacrosse'
+        expected = [(2, 11, 19), ({'rule': 5}, 15, 19), (None, 11, 25),
+                    (3, 23, 31)]
+        for shortcuts in (True, False):
+            for compact in (False, True):
+                kwtree = KeywordTree(case_insensitive=True,
+                                     shortcuts=shortcuts)
+                kwtree.add('malaga', 1)
+                kwtree.add('lacrosse', 3)
+                kwtree.add('mallorca', 2)
+                kwtree.add('mallorca bella')
+                kwtree.add('Orca', {'rule': 5})
+                kwtree.finalize(compact)
+
+                self.assertEqual(expected,
+                                 list(kwtree.search_all(text, values=True)))
+                self.assertEqual((2, 11, 19), kwtree.search(text, True))
+                self.assertEqual([(0, 2, 11, 19), (1, 1, 0, 6)],
+                                 list(kwtree.search_one_many(
+                                     [text, 'malaga'], values=True)))
+                self.assertEqual(
+                    [(0,) + result for result in expected],
+                    list(kwtree.search_many([text], values=True)))
+                self.assertEqual(
+                    expected, list(kwtree.search_stream(
+                        StringIO(text), chunk_size=3, values=True)))
+                scanner = kwtree.scanner(values=True)
+                self.assertEqual(expected[:2], scanner.feed(text[:20]))
+
+                pickled = loads(dumps(kwtree))
+                self.assertEqual(expected,
+                                 list(pickled.search_all(text, values=True)))
+
+                if not compact:
+                    kwtree.add('sylt', 'island')
+                    kwtree.add('mallorca', 'island')
+                    self.assertTrue(kwtree.remove('orca'))
+                    self.assertEqual(
+                        [('island', 11, 19), (None, 11, 25), (3, 23, 31),
+                         ('island', 35, 39)],
+                        list(kwtree.search_all(text + ' on sylt', True)))
+
+    def test_values_save_and_open(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'tree.ahocorapy')
+            kwtree = KeywordTree.from_keywords(
+                [('mallorca', {'category': 'island', 'severity': 2}),
+                 ('orca', 7), 'malaga'])
+            kwtree.save(path)
+            opened = KeywordTree.open(path)
+            self.assertEqual(
+                [({'category': 'island', 'severity': 2}, 0, 8),
+                 (7, 4, 8), (None, 9, 15)],
+                list(opened.search_all('mallorca malaga', values=True)))
+
+            path = os.path.join(directory, 'without_values.ahocorapy')
+            KeywordTree.from_keywords(['orca']).save(path)
+            opened = KeywordTree.open(path)
+            self.assertEqual([(None, 4, 8)],
+                             list(opened.search_all('mallorca', True)))
+
+            path = os.path.join(directory, 'changed_values.ahocorapy')
+            for value in ({1: 'y'}, (1, 2), [{'a': (1, 2)}], object()):
+                kwtree = KeywordTree.from_keywords([('orca', value)])
+                self.assertRaises(ValueError, kwtree.save, path)
+                self.assertFalse(os.path.exists(path))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_modes(self):
+        text = 'malheur on mallorca bellacrosse'
+        for shortcuts in (True, False):
+            for compact in (False, True):
+                kwtree = KeywordTree(shortcuts=shortcuts)
+                kwtree.add('malaga', 1)
+                kwtree.add('orca bella', 4)
+                kwtree.add('lacrosse', 3)
+                kwtree.add('mallorca', 2)
+                kwtree.add('mallorca bella', 5)
+                kwtree.add('orca', 6)
+                kwtree.finalize(compact)
+
+                self.assertEqual(
+                    [('mallorca', 11), ('lacrosse', 23)],
+                    list(kwtree.search_all(text, mode=NON_OVERLAPPING)))
+                self.assertEqual(
+                    [('mallorca bella', 11)],
+                    list(kwtree.search_all(text, mode=LEFTMOST_LONGEST)))
+                self.assertEqual(
+                    [('mallorca', 11), ('lacrosse', 23)],
+                    list(kwtree.search_all(text, mode=LEFTMOST_FIRST)))
+                self.assertEqual(
+                    [(5, 0, 14), (3, 15, 23)],
+                    list(kwtree.search_all('mallorca bella lacrosse',
+                                           values=True,
+                                           mode=LEFTMOST_LONGEST)))
+                self.assertEqual(('mallorca bella', 11),
+                                 kwtree.search(text, mode=LEFTMOST_LONGEST))
+                self.assertEqual(
+                    [(0, 'orca bella', 1), (1, 'orca', 0)],
+                    list(kwtree.search_many(['lorca bella', 'orca'],
+                                            mode=LEFTMOST_FIRST)))
+                self.assertRaises(ValueError, kwtree.search_all, text,
+                                  mode='longest')
+
+    def test_modes_random(self):
+        random = Random(7)
+
+        def expected_results(keywords, text, mode):
+            priorities = {}
+            for keyword in keywords:
+                priorities.setdefault(keyword, len(priorities))
+            results = []
+            position = 0
+            while True:
+                matches = [(start, start + len(keyword), keyword)
+                           for keyword in priorities
+                           for start in range(position, len(text))
+                           if text.startswith(keyword, start)]
+                if not matches:
+                    return results
+                if mode == NON_OVERLAPPING:
+                    end = min(match[1] for match in matches)
+                    match = max((match for match in matches
+                                 if match[1] == end),
+                                key=lambda match: len(match[2]))
+                else:
+                    start = min(match[0] for match in matches)
+                    matches = [match for match in matches
+                               if match[0] == start]
+                    if mode == LEFTMOST_LONGEST:
+                        match = max(matches, key=lambda match: match[1])
+                    else:
+                        match = min(matches,
+                                    key=lambda match: priorities[match[2]])
+                results.append((match[2], match[0]))
+                position = match[1]
+
+        for _ in range(100):
+            keywords = [''.join(random.choice('abc')
+                                for _ in range(random.randint(1, 4)))
+                        for _ in range(random.randint(1, 6))]
+            text = ''.join(random.choice('abc')
+                           for _ in range(random.randint(0, 25)))
+            for shortcuts in (True, False):
+                for compact in (False, True):
+                    kwtree = KeywordTree(shortcuts=shortcuts)
+                    for keyword in keywords:
+                        kwtree.add(keyword)
+                    kwtree.finalize(compact)
+                    kwtree = loads(dumps(kwtree))
+                    for mode in (NON_OVERLAPPING, LEFTMOST_FIRST,
+                                 LEFTMOST_LONGEST):
+                        self.assertEqual(
+                            expected_results(keywords, text, mode),
+                            list(kwtree.search_all(text, mode=mode)))
+
+    def test_output_links(self):
+        kwtree = KeywordTree()
+        kwtree.add('bcd')
+        kwtree.add('abcd')
+        kwtree.add('d')
+        kwtree.add('xabcd')
+        kwtree.finalize()
+        state = kwtree._zero_state
+        for char in 'xabc':
+            state = state.transitions[char]
+        self.assertFalse(state.success)
+        self.assertIsNone(state.output)
+        state = state.transitions['d']
+        self.assertEqual('abcd', state.output.matched_keyword)
+        self.assertEqual('bcd', state.output.output.matched_keyword)
+        self.assertEqual('d', state.output.output.output.matched_keyword)
+        self.assertIsNone(state.output.output.output.output)
+
+        kwtree.remove('bcd')
+        self.assertEqual('d', state.output.output.matched_keyword)
+        kwtree.remove('xabcd')
+        kwtree.add('cd')
+        self.assertEqual([('abcd', 1), ('cd', 3), ('d', 4)],
+                         list(kwtree.search_all('xabcd')))
+
+    def test_contains_and_count(self):
+        text = 'malheur on mallorca bellacrosse, mallorca'
+        for shortcuts in (True, False):
+            for compact in (False, True):
+                kwtree = KeywordTree(case_insensitive=True,
+                                     shortcuts=shortcuts)
+                kwtree.add('malaga')
+                kwtree.add('lacrosse')
+                kwtree.add('mallorca')
+                kwtree.add('mallorca bella')
+                kwtree.add('Orca')
+                kwtree.finalize(compact)
+
+                self.assertTrue(kwtree.contains(text))
+                self.assertTrue(kwtree.contains('ORCA'))
+                self.assertFalse(kwtree.contains('malheur on sylt'))
+                self.assertFalse(kwtree.contains(''))
+                self.assertEqual(6, kwtree.count(text))
+                self.assertEqual(0, kwtree.count('malheur on sylt'))
+                self.assertEqual(
+                    Counter({'mallorca': 2, 'Orca': 2, 'mallorca bella': 1,
+                             'lacrosse': 1}),
+                    kwtree.count(text, per_keyword=True))
+
+        kwtree = KeywordTree()
+        kwtree.add('orca')
+        self.assertRaises(ValueError, kwtree.contains, 'orca')
+        self.assertRaises(ValueError, kwtree.count, 'orca')
+
+    @unittest.skipIf(len(u'\u0130'.lower()) == 1,
+                     'lowercasing keeps the length before python 3')
+    def test_case_insensitive_offsets(self):
+        # 'İ'.lower() has two characters
+        text = u'İstanbul, Istanbul'
+        for shortcuts in (True, False):
+            for compact in (False, True):
+                kwtree = KeywordTree(case_insensitive=True,
+                                     shortcuts=shortcuts)
+                kwtree.add('Bul')
+                kwtree.add('istanbul')
+                kwtree.finalize(compact)
+
+                self.assertEqual([('Bul', 5), ('istanbul', 10), ('Bul', 15)],
+                                 list(kwtree.search_all(text)))
+                self.assertEqual([(None, 5, 8), (None, 10, 18),
+                                  (None, 15, 18)],
+                                 list(kwtree.search_all(text, values=True)))
+                self.assertEqual([('Bul', 5), ('istanbul', 10)],
+                                 list(kwtree.search_all(
+                                     text, mode=LEFTMOST_LONGEST)))
+                self.assertEqual([(0, 'Bul', 5), (1, 'Bul', 0),
+                                  (2, 'Bul', 5)],
+                                 list(kwtree.search_many(
+                                     [text[:8], 'Bul', text[:8]])))
+
+    def test_normalize(self):
+        text = u'Das ﬁle im CAFÉ: Crème brûlée, Ｃａｆｅ'
+        for shortcuts in (True, False):
+            for compact in (False, True):
+                kwtree = KeywordTree(case_insensitive=True, normalize=True,
+                                     shortcuts=shortcuts)
+                kwtree.add(u'file')
+                kwtree.add(u'café')
+                kwtree.add(u'creme brulee', 'dessert')
+                kwtree.finalize(compact)
+
+                results = list(kwtree.search_all(text, values=True))
+                self.assertEqual([u'ﬁle', u'CAFÉ', u'Crème brûlée',
+                                  u'Ｃａｆｅ'],
+                                 [text[start:end]
+                                  for _, start, end in results])
+                self.assertEqual('dessert', results[2][0])
+                self.assertEqual([(u'file', 4), (u'café', 11),
+                                  (u'creme brulee', 17), (u'café', 31)],
+                                 list(kwtree.search_all(text)))
+                self.assertEqual(4, kwtree.count(text))
+                self.assertEqual([(1, u'café', 1)],
+                                 list(kwtree.search_many(['x', u'xcafe'])))
+
+                unpickled = loads(dumps(kwtree))
+                self.assertEqual(list(kwtree.search_all(text)),
+                                 list(unpickled.search_all(text)))
+
+        kwtree = KeywordTree(normalize=True)
+        kwtree.add(u'Cafe')
+        kwtree.finalize()
+        self.assertEqual([(u'Cafe', 0)], list(kwtree.search_all(u'Café')))
+        self.assertEqual([], list(kwtree.search_all(u'CAFE')))
+
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'kwtree.aho')
+            kwtree.save(path)
+            opened = KeywordTree.open(path)
+            self.assertEqual([(u'Cafe', 2)],
+                             list(opened.search_all(u'a Café')))
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertRaises(ValueError, KeywordTree, normalize=True,
+                          binary=True)
+
+    def test_word_boundaries(self):
+        text = 'Mallorca, mallorcas and orcas. Orca_x orca-y la orca'
+        for shortcuts in (True, False):
+            for compact in (False, True):
+                kwtree = KeywordTree(case_insensitive=True,
+                                     shortcuts=shortcuts,
+                                     word_boundaries=True)
+                kwtree.add('mallorca')
+                kwtree.add('orca')
+                kwtree.add('la orca')
+                kwtree.finalize(compact)
+
+                self.assertEqual([('mallorca', 0), ('orca', 38),
+                                  ('la orca', 45), ('orca', 48)],
+                                 list(kwtree.search_all(text)))
+                self.assertEqual([('mallorca', 0), ('orca', 38),
+                                  ('la orca', 45)],
+                                 list(kwtree.search_all(
+                                     text, mode=LEFTMOST_LONGEST)))
+                self.assertEqual([(0, 'orca', 0), (2, 'la orca', 0),
+                                  (2, 'orca', 3)],
+                                 list(kwtree.search_many(
+                                     ['orca', 'orcas', 'la orca'])))
+                self.assertEqual(4, kwtree.count(text))
+                self.assertTrue(kwtree.contains('orca!'))
+                self.assertFalse(kwtree.contains('orcas'))
+                self.assertRaises(ValueError, kwtree.scanner)
+
+        kwtree = KeywordTree(word_boundaries=True, word_characters='abc-')
+        kwtree.add('b')
+        kwtree.finalize()
+        self.assertEqual([('b', 3), ('b', 5)],
+                         list(kwtree.search_all('ab b1b -b')))
+
+        kwtree = KeywordTree(binary=True, word_boundaries=True)
+        kwtree.add(b'orca')
+        kwtree.finalize()
+        self.assertEqual([(b'orca', 6)],
+                         list(kwtree.search_all(b'orcas orca')))
+
+        kwtree = KeywordTree(word_boundaries=True)
+        kwtree.add('orca')
+        kwtree.finalize()
+        text = ' '.join(['orca', 'orcas', 'xorca'] * 20)
+        with ParallelSearcher(kwtree, processes=2,
+                              chunk_size=7) as searcher:
+            self.assertEqual(list(kwtree.search_all(text)),
+                             list(searcher.search_all(text)))
+
+    def test_patterns(self):
+        text = u'Buy V1AGRA or viagra, FREE-money, freemoney! xabcd y7'
+        for compact in (False, True):
+            kwtree = KeywordTree(case_insensitive=True)
+            kwtree.add('agra')
+            kwtree.add_pattern('v[i1!]agra', 'spam')
+            kwtree.add_pattern('free?money')
+            kwtree.add_pattern('{x}abc{d}')
+            kwtree.add_pattern('[xy][0-9]')
+            kwtree.finalize(compact)
+
+            self.assertEqual(
+                [('v[i1!]agra', 4), ('agra', 6), ('v[i1!]agra', 14),
+                 ('agra', 16), ('free?money', 22), ('{x}abc{d}', 45),
+                 ('{x}abc{d}', 46), ('{x}abc{d}', 45), ('{x}abc{d}', 46),
+                 ('[xy][0-9]', 51)],
+                list(kwtree.search_all(text)))
+            self.assertEqual([('spam', 4, 10), ('spam', 14, 20)],
+                             [result for result in
+                              kwtree.search_all(text, values=True)
+                              if result[0] == 'spam'])
+            self.assertEqual(10, kwtree.count(text))
+            self.assertTrue(kwtree.contains('v!agra'))
+            self.assertFalse(kwtree.contains('vlagr'))
+            self.assertEqual(list(kwtree.search_all(text)),
+                             list(loads(dumps(kwtree)).search_all(text)))
+            self.assertRaises(ValueError, kwtree.search_all, text,
+                              mode=LEFTMOST_LONGEST)
+            self.assertRaises(ValueError, kwtree.scanner)
+
+        kwtree = KeywordTree()
+        kwtree.add_pattern('ab?')
+        kwtree.finalize()
+        kwtree.add_pattern('?cd')
+        kwtree.add('b')
+        kwtree.add_pattern(r'\?[^a]')
+        self.assertEqual([('ab?', 0), ('b', 1), ('?cd', 2), ('\\?[^a]', 5),
+                          ('b', 6), ('b', 9)],
+                         list(kwtree.search_all('abxcd?b ab')))
+        self.assertTrue(kwtree.remove('b'))
+        self.assertFalse(kwtree.remove('ab'))
+        self.assertEqual([('ab?', 0), ('?cd', 2)],
+                         list(kwtree.search_all('abxcd ab')))
+        self.assertRaises(ValueError, kwtree.save, 'kwtree.aho')
+
+        # The factor occurs twice in the match 'aa'
+        kwtree = KeywordTree()
+        kwtree.add_pattern('{a}a{a}')
+        kwtree.finalize()
+        self.assertEqual([(None, 0, 1), (None, 0, 2), (None, 1, 2)],
+                         list(kwtree.search_all('aa', values=True)))
+        self.assertEqual(3, kwtree.count('aa'))
+
+        for pattern in ('???', '{a}', 'a[bc', 'a{bc}', 'a\\'):
+            self.assertRaises(ValueError, KeywordTree().add_pattern, pattern)
+        self.assertRaises(ValueError, KeywordTree(binary=True).add_pattern,
+                          'a?')
+        self.assertRaises(ValueError,
+                          KeywordTree(word_boundaries=True).add_pattern, 'a?')
+
+    def test_patterns_random(self):
+        # Patterns have to find the same matches as all the keywords they
+        # stand for.
+        rand = Random(20)
+        alphabet = 'abc'
+        classes = ['[ab]', '[bc]', '[a-c]']
+        for _ in range(50):
+            patterns = []
+            expanded = {}
+            for _ in range(rand.randint(1, 4)):
+                parts = []
+                for _ in range(rand.randint(1, 5)):
+                    kind = rand.random()
+                    if kind < 0.5:
+                        char = rand.choice(alphabet)
+                        parts.append((char, [char]))
+                    elif kind < 0.75:
+                        chars = rand.choice(classes)
+                        expansion = [char for char in alphabet
+                                     if char in chars or chars == '[a-c]']
+                        parts.append((chars, expansion))
+                    elif kind < 0.85:
+                        parts.append(('?', list(alphabet)))
+                    else:
+                        char = rand.choice(alphabet)
+                        parts.append(('{' + char + '}', ['', char]))
+                pattern = ''.join(part for part, _ in parts)
+                keywords = set([''])
+                for _, expansion in parts:
+                    keywords = set(keyword + char for keyword in keywords
+                                   for char in expansion)
+                keywords.discard('')
+                if not any(part[0] not in '?{' for part, _ in parts) or \
+                        pattern in expanded:
+                    continue
+                patterns.append(pattern)
+                expanded[pattern] = keywords
+            text = ''.join(rand.choice(alphabet) for _ in range(40))
+
+            kwtree = KeywordTree()
+            for pattern in patterns:
+                kwtree.add_pattern(pattern)
+            kwtree.finalize()
+            expected = set()
+            for pattern, keywords in expanded.items():
+                for keyword in keywords:
+                    start = text.find(keyword)
+                    while start >= 0:
+                        expected.add((pattern, start, start + len(keyword)))
+                        start = text.find(keyword, start + 1)
+            # Every match is reported once
+            self.assertEqual(
+                sorted(expected),
+                sorted((pattern, start, end) for (_, start, end), (pattern, _)
+                       in zip(kwtree.search_all(text, values=True),
+                              kwtree.search_all(text))))
+
+    def test_search_fuzzy(self):
+        text = 'Buy VIAGRA or viagrra, v1agra, casin0 cassino bitcoinwallet'
+        for compact in (False, True):
+            kwtree = KeywordTree(case_insensitive=True)
+            kwtree.add('viagra', 'spam')
+            kwtree.add('casino')
+            kwtree.add('bitcoin wallet')
+            kwtree.add('a')
+            kwtree.finalize(compact)
+
+            self.assertEqual(
+                [('viagra', 4, 0), ('viagra', 14, 1), ('viagra', 23, 1),
+                 ('casino', 31, 1), ('casino', 38, 1),
+                 ('bitcoin wallet', 46, 1)],
+                list(kwtree.search_fuzzy(text)))
+            self.assertEqual(
+                [('spam', 4, 10, 0), ('spam', 14, 21, 1),
+                 ('spam', 23, 29, 1)],
+                list(kwtree.search_fuzzy(text, values=True))[:3])
+            self.assertEqual(
+                [('viagra', 4, 0), ('viagra', 14, 1), ('viagra', 23, 1),
+                 ('casino', 31, 1)],
+                list(kwtree.search_fuzzy(text, substitutions_only=True)))
+            self.assertEqual(
+                sorted((keyword, start, 0) for keyword, start
+                       in kwtree.search_all(text)),
+                sorted(kwtree.search_fuzzy(text, max_edits=0)))
+            self.assertEqual([('viagra', 0, 2)],
+                             list(kwtree.search_fuzzy('vagr', max_edits=2)))
+            self.assertRaises(ValueError, kwtree.search_fuzzy, text,
+                              max_edits=-1)
+
+        kwtree = KeywordTree(normalize=True, word_boundaries=True)
+        kwtree.add('cafe')
+        kwtree.finalize()
+        self.assertEqual([('cafe', 0, 1), ('cafe', 11, 1)],
+                         list(kwtree.search_fuzzy(u'Caf\u00e9 cafes caffe')))
+        kwtree.add('caffeine')
+        self.assertEqual([('cafe', 0, 0), ('caffeine', 5, 1)],
+                         list(kwtree.search_fuzzy(u'c\u00e4fe cafeine')))
+        self.assertRaises(ValueError, KeywordTree().search_fuzzy, 'text')
+
+    def test_search_fuzzy_random(self):
+        # Compares with the distances of all starts computed by brute force
+        rand = Random(21)
+        for substitutions_only in (False, True):
+            for _ in range(50):
+                max_edits = rand.randint(0, 2)
+                keywords = set(''.join(rand.choice('abc') for _ in
+                                       range(rand.randint(3, 6)))
+                               for _ in range(rand.randint(1, 4)))
+                text = ''.join(rand.choice('abc') for _ in range(30))
+                kwtree = KeywordTree.from_keywords(
+                    (keyword, keyword) for keyword in keywords)
+                expected = set()
+                for keyword in keywords:
+                    if len(keyword) <= max_edits:
+                        continue
+                    # Smallest distance and longest end of every start
+                    best = {}
+                    for start in range(len(text) + 1):
+                        best[start] = min(
+                            (self._distance(keyword, text[start:end],
+                                            substitutions_only), -end)
+                            for end in range(start, len(text) + 1))
+                    matches = [(start, distance, -end) for start,
+                               (distance, end) in best.items()
+                               if distance <= max_edits]
+                    for start, distance, end in matches:
+                        # Not reported if an overlapping match is better
+                        if any(other_start != start and
+                               other_start < end and other_end > start and
+                               (other_distance < distance or
+                                (other_distance == distance and distance and
+                                 other_start < start))
+                               for other_start, other_distance, other_end
+                               in matches):
+                            continue
+                        expected.add((keyword, start, end, distance))
+                self.assertEqual(expected, set(kwtree.search_fuzzy(
+                    text, max_edits, values=True,
+                    substitutions_only=substitutions_only)))
+
+    @staticmethod
+    def _distance(keyword, text, substitutions_only):
+        if substitutions_only:
+            if len(keyword) != len(text):
+                return len(keyword) + len(text)
+            return sum(1 for a, b in zip(keyword, text) if a != b)
+        row = list(range(len(text) + 1))
+        for idx, char in enumerate(keyword):
+            previous = row
+            row = [idx + 1]
+            for column in range(1, len(text) + 1):
+                row.append(min(previous[column] + 1, row[column - 1] + 1,
+                               previous[column - 1] +
+                               (text[column - 1] != char)))
+        return row[-1]
+
 
 if __name__ == '__main__':
     unittest.main()